@@ -2,7 +2,9 @@
 
 import datetime
 import os
+import random
 import sys
+import time
 
 if os.name == 'posix' and sys.version_info[0] < 3:
     import subprocess32 as subprocess
@@ -10,6 +12,107 @@ else:
     import subprocess
 
 import multiprocessing
+import threading
+import Queue
+from collections import deque
+
+BACKEND_PROCESSES = 'processes'
+BACKEND_THREADS = 'threads'
+BACKEND_INLINE = 'inline'
+BACKENDS = [BACKEND_PROCESSES, BACKEND_THREADS, BACKEND_INLINE]
+
+# job_count value asking for the number of parallel jobs to be tuned while running
+JOBS_AUTO = 'auto'
+
+# group_limits key giving the limit for every group not named
+ANY_GROUP = '*'
+
+
+class JobAutotuner(object):
+    """
+    Choose how many tasks to run at once while a batch is running.
+
+    Every time a window of tasks (as many as are currently allowed to run) has completed,
+    the throughput over that window, in tasks per second, is compared with the previous
+    window's, and the job count is adjusted:
+      - a failure or retry in the window halves it, since the server may be throttling us
+      - a 1 minute load average above the CPU count steps it down by one
+      - otherwise it keeps stepping the same way while throughput improves, and turns
+        around when throughput falls
+    """
+    def __init__(self, minimum=1, maximum=None, start=None):
+        try:
+            self._cpus = multiprocessing.cpu_count()
+        except NotImplementedError:
+            self._cpus = 1
+
+        self.minimum = max(minimum, 1)
+        self.maximum = max(maximum or min(self._cpus * 4, 32), self.minimum)
+        self.jobs = max(min(start or self._cpus, self.maximum), self.minimum)
+
+        self._direction = 1
+        self._last_throughput = None
+        self._window_start = time.time()
+        self._window_count = 0
+        self._window_trouble = False
+
+
+    def _load(self):
+        """
+        :return: the 1 minute load average, or 0 if the platform doesn't say
+        """
+        try:
+            return os.getloadavg()[0]
+        except (AttributeError, OSError):
+            return 0
+
+
+    def observe(self, results):
+        """
+        Note a completed task
+        :param results: the task's results
+        :return: the number of tasks which should now be allowed to run at once
+        """
+        self._window_count += 1
+        if (results.get('status') != 'success' or
+                results.get('task', {}).get('attempt_count', 1) > 1):
+            self._window_trouble = True
+
+        if self._window_count < max(self.jobs, 2):
+            return self.jobs
+
+        now = time.time()
+        throughput = self._window_count / max(now - self._window_start, 0.001)
+        load = self._load()
+        previous = self.jobs
+
+        if self._window_trouble:
+            self.jobs = previous // 2
+            self._direction = 1
+            throughput = None
+        elif load > self._cpus:
+            self.jobs = previous - 1
+            self._direction = -1
+        elif self._last_throughput is None or throughput > self._last_throughput * 1.05:
+            self.jobs = previous + self._direction
+        elif throughput < self._last_throughput * 0.95:
+            self._direction = -self._direction
+            self.jobs = previous + self._direction
+
+        self.jobs = max(min(self.jobs, self.maximum), self.minimum)
+        if self.jobs != previous:
+            print "Parallel jobs {0} -> {1} ({2} tasks/s, load {3:.1f}{4})".format(
+                previous, self.jobs,
+                "{0:.2f}".format(throughput) if throughput is not None else "-",
+                load,
+                ", failures or retries seen" if self._window_trouble else "")
+
+        self._last_throughput = throughput
+        self._window_start = now
+        self._window_count = 0
+        self._window_trouble = False
+        return self.jobs
+
 
 class ParallelTasks(object):
     """
@@ -21,50 +124,383 @@ class ParallelTasks(object):
     process.   Various timing and other housekeeping results will be collected without the
     assistance of the do_one_task method.
 
-    All results will be returned in a dictionary shared amongst all processes.   The do_one_task
-    should populate the passed in results dictionary, which will then be collected by the parent
-    and saved per-child, using the passed in task name as the key.
+    The do_one_task should populate the passed in results dictionary.   When the task is done,
+    the child sends that dictionary back to the parent as a single pickled record over a
+    result queue, and the parent saves it per-child, using the passed in task name as the key.
+    Records are drained by the parent as they arrive, so no shared server process is needed.
+
+    The execution backend is selectable:
+      'processes' - one forked worker process per job (the default)
+      'threads'   - one worker thread per job; best for tasks that mostly wait on subprocesses
+      'inline'    - no workers, each task is run in the caller as it is added
+    Subclasses may change the default via the default_backend class attribute.
+
+    The workers are started once and may be used for several batches of tasks: add a
+    batch, wait() for it, and add the next.   close() stops the workers; finish() is a
+    wait() followed by a close().   Used as a context manager, the workers are always
+    stopped on leaving the block.
+
+    Each attempt at a task may be given a time limit (task_timeout seconds).   The limit is
+    published to do_one_task as results['task']['deadline'], a time.time() value, which the
+    subclass must honour (e.g. by killing the command it is running).   A task which fails
+    with one of the retryable_exceptions is retried up to retries times, sleeping for an
+    exponentially growing, jittered delay starting at retry_delay seconds in between.   Every
+    attempt is recorded in results['task']['attempts'].
+
+    A task may depend on other tasks, by name.   It is held back until all of those tasks
+    have finished, and is dispatched as soon as they have, without waiting for any unrelated
+    task.   If any of them did not finish with a 'success' status, the task is not run at
+    all and is reported with a 'skipped' status instead.
+
+    The parent hands at most job_count tasks to the workers at a time.   With a job_count
+    of 'auto', a JobAutotuner changes that number while tasks are running.
+
+    Tasks may also be put in groups (such as the server they talk to), and group_limits
+    caps how many tasks of each group run at once, by group name (ANY_GROUP for every
+    group not named).   A ready task whose group is at its limit waits, and later ready
+    tasks of other groups are run ahead of it.
+
+    cancel() stops a batch early: tasks not yet started are reported as 'cancelled', and
+    running tasks are asked to stop by setting the event from get_cancel_event(), which
+    do_one_task should watch (e.g. by passing it to GitBit.run).   With fail_fast, the first
+    task to fail cancels the rest of its batch.   Otherwise every task is run to completion.
 
     """
-    def __init__(self, job_count):
-        if job_count < 1:
-            job_count = 1
-
-        self._notification_queue = multiprocessing.JoinableQueue()
-        self._manager = multiprocessing.Manager()
-        self._shared_results = self._manager.dict()
-
-        self._processes = [multiprocessing.Process(target=self._run_task_queue)
-                           for i in range(job_count)
-                          ]
+    default_backend = BACKEND_PROCESSES
+
+    # seconds to wait for a worker to exit when closing after an error
+    abort_timeout = 5
+
+    # failures which are worth another attempt
+    retryable_exceptions = (RuntimeError, EnvironmentError)
+
+    def __init__(self, job_count, backend=None, task_timeout=None, retries=0, retry_delay=1.0,
+                 group_limits=None, fail_fast=False):
+        self._autotuner = None
+        if job_count == JOBS_AUTO:
+            # start enough workers for the most jobs allowed, and limit how many are busy
+            self._autotuner = JobAutotuner()
+            job_count = self._autotuner.maximum
+            self._job_limit = self._autotuner.jobs
+        else:
+            if job_count < 1:
+                job_count = 1
+            self._job_limit = job_count
+
+        if retries < 0:
+            retries = 0
+
+        if backend is None:
+            backend = self.default_backend
+
+        if backend not in BACKENDS:
+            raise ValueError("unknown backend '{0}', expected one of {1}".format(backend, BACKENDS))
+
+        self._backend = backend
+        self._task_timeout = task_timeout
+        self._retries = retries
+        self._retry_delay = retry_delay
+        self._fail_fast = fail_fast
+        self._group_limits = dict(group_limits or {})
+        self._group_running = {}
+        self._task_groups = {}
+        self._results = {}
+        self._completed = {}
+        self._pending = []
+        self._ready = deque()
+        self._finished = deque()
+        self._outstanding = 0
+        self._in_flight = 0
+        self._batch = []
+        self._closed = False
+
+        if backend == BACKEND_PROCESSES:
+            self._cancel_event = multiprocessing.Event()
+            self._notification_queue = multiprocessing.Queue()
+            self._result_queue = multiprocessing.Queue()
+            self._processes = [multiprocessing.Process(target=self._run_task_queue)
+                               for i in range(job_count)
+                              ]
+        elif backend == BACKEND_THREADS:
+            self._cancel_event = threading.Event()
+            self._notification_queue = Queue.Queue()
+            self._result_queue = Queue.Queue()
+            self._processes = [threading.Thread(target=self._run_task_queue)
+                               for i in range(job_count)
+                              ]
+        else:
+            self._cancel_event = threading.Event()
+            self._notification_queue = None
+            self._result_queue = Queue.Queue()
+            self._processes = []
 
         for process in self._processes:
+            process.daemon = True
             process.start()
 
 
+    def get_job_limit(self):
+        """
+        :return: how many tasks are currently allowed to run at once
+        """
+        return self._job_limit
+
+
+    def get_backend(self):
+        """
+        :return: the name of the execution backend in use
+        """
+        return self._backend
+
+
+    def get_cancel_event(self):
+        """
+        :return: the event which is set when the current batch is cancelled; usable from
+                 the workers
+        """
+        return self._cancel_event
+
+
+    def cancel(self):
+        """
+        Stop the current batch: tasks not yet started are withdrawn and reported as
+        'cancelled', and running tasks are asked to stop (see get_cancel_event).   Their
+        results are still collected as usual.
+        :return: None
+        """
+        self._cancel_event.set()
+        self._cancel_queued()
+
+
     def get_results(self):
         """
         Return the current result status from all subprocesses that have completed
         :return: subprocess results, keyed via 'name' passed in to add_task
         """
-        return self._shared_results
+        self._drain_results(block=False)
+        return self._results
+
+
+    def as_completed(self):
+        """
+        Iterate over the tasks added since the previous wait(), in the order they finish.
+        Each task's results are yielded as soon as they arrive, and are not kept:
+        they will not appear in get_results() or wait().
+
+        :return: generator of (name, results) pairs
+        """
+        for (name, results) in self._collect(block=True):
+            yield name, results
+        self._batch_done()
+
+
+    def _drain_results(self, block):
+        """
+        Collect result records sent back by the child processes, and keep them.
+
+        :param block: if True, wait until every outstanding task has reported back;
+                      otherwise only collect the records that are already available
+        :return: None
+        """
+        for (name, results) in self._collect(block):
+            self._results[name] = results
+
+
+    def _collect(self, block):
+        """
+        Generate (name, results) for each task as it finishes (or is skipped).
+
+        :param block: if True, wait until every outstanding task has reported back;
+                      otherwise only the records that are already available
+        """
+        while True:
+            while self._finished:
+                yield self._finished.popleft()
+
+            if self._outstanding == 0:
+                return
+
+            if self._in_flight == 0:
+                if not block:
+                    return
+                # nothing is running, so whatever is left waits on tasks that will never finish
+                self._fail_unresolved()
+                continue
+
+            try:
+                (name, results) = self._result_queue.get(block)
+            except Queue.Empty:
+                return
+
+            self._in_flight -= 1
+            self._group_done(name)
+            if self._autotuner is not None:
+                self._job_limit = self._autotuner.observe(results)
+            self._record(name, results)
+            self._dispatch()
+
+
+    def _record(self, name, results):
+        """
+        Note a finished (or skipped) task, and queue its results for collection
+        """
+        self._completed[name] = results.get('status')
+        self._outstanding -= 1
+        self._finished.append((name, results))
+
+        if self._fail_fast and results.get('status') in ('exception', 'error') and \
+           not self._cancel_event.is_set():
+            print "Cancelling the remaining tasks after {0} failed".format(name)
+            self.cancel()
+
+
+    def _dispatch(self):
+        """
+        Hand every task whose dependencies have all finished to the workers.   Tasks
+        depending on a task which did not succeed are skipped.
+        """
+        progress = True
+        while progress:
+            progress = False
+            for entry in list(self._pending):
+                (name, data, depends_on, group) = entry
+                if any(dependency not in self._completed for dependency in depends_on):
+                    continue
+
+                self._pending.remove(entry)
+                progress = True
+
+                failed = [dependency for dependency in depends_on
+                          if self._completed[dependency] != 'success']
+                if failed:
+                    self._record(name, {'task': {'name': name},
+                                        'status': 'skipped',
+                                        'failed_dependencies': failed
+                                       })
+                else:
+                    self._ready.append((name, data, group))
+
+            # only the allowed number of tasks are handed to the workers at once
+            while self._ready and (self._backend == BACKEND_INLINE or
+                                   self._in_flight < self._job_limit):
+                entry = self._next_ready()
+                if entry is None:
+                    break
+                (name, data, group) = entry
+                self._submit(name, data, group)
+                progress = True
+
+
+    def _group_limit(self, group):
+        """
+        :return: the most tasks of group allowed to run at once, None for no limit
+        """
+        if group is None:
+            return None
+        limit = self._group_limits.get(group, self._group_limits.get(ANY_GROUP))
+        if limit is None:
+            return None
+        return max(limit, 1)
+
+
+    def _next_ready(self):
+        """
+        Take the first ready task whose group is below its limit
+        :return: (name, data, group), or None if every ready task has to wait
+        """
+        for entry in self._ready:
+            limit = self._group_limit(entry[2])
+            if limit is None or self._group_running.get(entry[2], 0) < limit:
+                self._ready.remove(entry)
+                return entry
+        return None
+
+
+    def _group_done(self, name):
+        """
+        Note that a task handed to the workers is no longer running
+        """
+        group = self._task_groups.pop(name, None)
+        if group is not None:
+            self._group_running[group] -= 1
 
 
-    def add_task(self, data, name):
+    def _submit(self, name, data, group=None):
+        """
+        Run a task which is ready to go, via the backend
+        """
+        if self._backend == BACKEND_INLINE:
+            self._record(name, self._run_one_task(name, data))
+            return
+
+        if self._notification_queue is None:
+            raise RuntimeError("no notification queue available")
+
+        self._notification_queue.put((name, data))
+        self._in_flight += 1
+        if group is not None:
+            self._task_groups[name] = group
+            self._group_running[group] = self._group_running.get(group, 0) + 1
+
+
+    def _fail_unresolved(self):
+        """
+        Give up on the tasks still waiting on dependencies which were never added or
+        which depend on each other
+        """
+        for (name, data, depends_on, group) in self._pending:
+            self._record(name, {'task': {'name': name},
+                                'status': 'unresolved',
+                                'waiting_on': [dependency for dependency in depends_on
+                                               if dependency not in self._completed]
+                               })
+        self._pending = []
+
+
+    def _cancel_queued(self):
+        """
+        Withdraw every task that has not been started yet, reporting it as 'cancelled'
+        """
+        cancelled = [entry[0] for entry in self._pending]
+        cancelled.extend([entry[0] for entry in self._ready])
+        self._pending = []
+        self._ready.clear()
+
+        if self._notification_queue is not None:
+            try:
+                while True:
+                    (name, data) = self._notification_queue.get_nowait()
+                    self._in_flight -= 1
+                    self._group_done(name)
+                    cancelled.append(name)
+            except Queue.Empty:
+                pass
+
+        for name in cancelled:
+            self._record(name, {'task': {'name': name}, 'status': 'cancelled'})
+
+
+    def add_task(self, data, name, depends_on=None, group=None):
         """
         Initiate the checkout process -- this notifies the worker queue that a
         specific repository needs to be checked out
 
         :param data: arbitrary data to be passed to a worker child process
         :param name: the key by which this data's job results will be returned
+        :param depends_on: optional list of task names which must finish successfully
+                           before this task is run
+        :param group: optional group name, for limiting how many of the group run at once
         """
         if data is None or name is None:
             raise ValueError ("no task parameter may be none")
 
-        if self._notification_queue is None:
-            raise RuntimeError("no notification queue available")
+        if self._closed:
+            raise RuntimeError("no workers available, the task pool is closed")
 
-        self._notification_queue.put((name, data))
+        self._batch.append(name)
+        self._outstanding += 1
+        self._pending.append((name, data, list(depends_on or []), group))
+        self._dispatch()
 
 
     def _run_task_queue(self):
@@ -72,38 +508,128 @@ class ParallelTasks(object):
         Continually check the notification queue for work to do, and then do it
         :return:
 
-        This function will run forever.   When there are no more items in the work queue,
-        the main process will terminate all of the child processes, which will all be waiting
-        on Queue.get() to return a value (which won't be coming)
+        This function runs until it receives a None sentinel from close().
+
+        Each finished task is reported back to the parent as one (name, results) record
+        on the result queue.
 
         """
         while True:
-            (name,data) = self._notification_queue.get()
+            item = self._notification_queue.get()
+            if item is None:
+                return
+
+            (name,data) = item
 
             if name is None or data is None:
                 raise ValueError("will not run a job without name or data")
 
-            results = { 'task': {}}
-            results['task']['start_time'] = datetime.datetime.now()
-            results['task']['name'] = name
-            results['task']['pid'] = os.getpid()
-            results['task']['ppid'] = os.getppid()
+            self._result_queue.put((name, self._run_one_task(name, data)))
+
 
+    def _run_one_task(self, name, data):
+        """
+        Run a single task, wrapping do_one_task with the housekeeping results and
+        retrying it as configured
+
+        :param name: the key by which this task's results will be returned
+        :param data: arbitrary data passed to do_one_task
+        :return: the results dictionary for the task
+        """
+        task = {}
+        task['start_time'] = datetime.datetime.now()
+        task['name'] = name
+        task['pid'] = os.getpid()
+        task['ppid'] = os.getppid()
+        task['thread'] = threading.current_thread().ident
+        task['attempts'] = []
+
+        while True:
+            results = { 'task': task}
+            attempt = {'start_time': datetime.datetime.now()}
+            task['deadline'] = None
+            if self._task_timeout is not None:
+                task['deadline'] = time.time() + self._task_timeout
+
+            if self._cancel_event.is_set():
+                results['status'] = 'cancelled'
+                break
+
+            exception = None
             try:
                 self.do_one_task(name, data, results)
             except Exception as ex: # pylint: disable=broad-except
+                exception = ex
                 results['exception'] = ex
                 results['status'] = 'exception'
             except: # catch *all* exceptions # pylint: disable=bare-except
                 results['error'] = sys.exc_info()[0]
                 results['status'] = 'error'
 
-            self._shared_results[name] = results
+            if 'status' in results and self._cancel_event.is_set() and results['status'] != 'success':
+                # the task was stopped by cancel(), rather than failing by itself
+                results['status'] = 'cancelled'
+
+            attempt['end_time'] = datetime.datetime.now()
+            attempt['elapsed_time'] = attempt['end_time'] - attempt['start_time']
+            attempt['status'] = results.get('status')
+            if exception is not None:
+                attempt['exception'] = str(exception)
+            task['attempts'].append(attempt)
+
+            if (exception is None or
+                    self._cancel_event.is_set() or
+                    len(task['attempts']) > self._retries or
+                    not self.should_retry(name, data, exception)):
+                break
 
-            results['task']['end_time'] = datetime.datetime.now()
-            results['task']['elapsed_time'] = results['task']['end_time'] - results['task']['start_time']
+            delay = float(self._retry_delay) * (2 ** (len(task['attempts']) - 1))
+            time.sleep(random.uniform(delay / 2, delay))
+            self.prepare_retry(name, data, results)
+
+        task['attempt_count'] = len(task['attempts'])
+        task['end_time'] = datetime.datetime.now()
+        task['elapsed_time'] = task['end_time'] - task['start_time']
+
+        return results
+
+
+    @staticmethod
+    def last_attempt_seconds(results):
+        """
+        :param results: the results of a finished task
+        :return: how long the final attempt at the task took, in seconds (None if never run)
+        """
+        attempts = results.get('task', {}).get('attempts')
+        if not attempts:
+            return None
+        return attempts[-1]['elapsed_time'].total_seconds()
+
+
+    def should_retry(self, name, data, exception):
+        """
+        Decide whether a failed attempt at a task is worth repeating
+
+        :param name: the task name
+        :param data: the task data
+        :param exception: the exception raised by do_one_task
+        :return: True to try again (if attempts remain)
+        """
+        return isinstance(exception, self.retryable_exceptions)
+
+
+    def prepare_retry(self, name, data, results):
+        """
+        Undo whatever a failed attempt left behind, before the task is tried again.
+        Does nothing unless overridden.
+
+        :param name: the task name
+        :param data: the task data
+        :param results: the results of the failed attempt
+        :return: None
+        """
+        pass
 
-            self._notification_queue.task_done()
 
     def do_one_task(self, name, data, results):
         """
@@ -124,19 +650,74 @@ class ParallelTasks(object):
         raise NotImplementedError("__do_one_task must be implemented by a subclass")
 
 
+    def wait(self):
+        """
+        Wait for every task added so far to complete.   The workers are left running,
+        so more tasks may be added afterwards as a new batch.
+
+        :return: the results of the tasks added since the previous wait(), keyed by name
+        """
+        # Block until every task has sent its result record back.   The records must be
+        # read before the children are stopped, or data still buffered in a child's
+        # queue feeder thread would be lost.
+        self._drain_results(block=True)
+
+        batch = dict((name, self._results[name]) for name in self._batch if name in self._results)
+        self._batch_done()
+        return batch
+
+
+    def _batch_done(self):
+        """
+        Start a new batch, reporting the job count that was settled on if it was tuned
+        """
+        if self._autotuner is not None and self._batch:
+            print "Parallel jobs settled at {0}".format(self._job_limit)
+        self._batch = []
+        self._cancel_event.clear()
+
+
+    def close(self, abort=False):
+        """
+        Stop the workers.   Each worker is sent a None sentinel and exits on its own once
+        it has finished the work ahead of it, so child processes get to flush their output
+        and run their normal cleanup.
+
+        :param abort: discard tasks that have not been started yet, ask the running ones to
+                      stop (see cancel), and terminate any child process that does not exit
+                      promptly
+        :return: none
+        """
+        if self._closed:
+            return
+        self._closed = True
+
+        if abort:
+            self.cancel()
+
+        for worker in self._processes:
+            self._notification_queue.put(None)
+
+        for worker in self._processes:
+            worker.join(self.abort_timeout if abort else None)
+            if worker.is_alive() and self._backend == BACKEND_PROCESSES:
+                worker.terminate()
+
+
     def finish(self):
         """
-        Wait for all of the subprocesses to complete all assigned tasks.
+        Wait for all of the subprocesses to complete all assigned tasks, then stop them.
 
         :return: none
         """
+        self.wait()
+        self.close()
 
-        # Block until all items in the queue have been gotten and processed.
-        self._notification_queue.join()
 
-        # so now we can do through all of the child processes and stop them
-        # (extreme prejudice is okay, since all work has been performed and they're
-        # just waiting on the queue.get() operation).
-        for process in self._processes:
-            process.terminate()
+    def __enter__(self):
+        return self
+
 
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(abort=exc_type is not None)
+        return False
@@ -1,8 +1,23 @@
 
+import datetime
 import os
+import shutil
+import threading
+from urlparse import urlparse
 import config
-from gitbits import GitBit
-from ParallelTasks import ParallelTasks
+from gitbits import GitBit, GitCommandLoop, GitQuery
+from git_refs import RefReader
+from mirror_cache import MirrorCache, FileLock
+from remote_refs import RemoteRefsCache
+from ParallelTasks import ParallelTasks, BACKEND_PROCESSES, BACKEND_THREADS
+from task_history import TaskHistory
+
+# how much of a repository a checkout fetches: everything, only the checked out commit
+# (--depth 1), or every commit but only the file contents needed (--filter=blob:none)
+CLONE_FULL = 'full'
+CLONE_SHALLOW = 'shallow'
+CLONE_BLOBLESS = 'blobless'
+CLONE_MODES = (CLONE_FULL, CLONE_SHALLOW, CLONE_BLOBLESS)
 
 def strip_suffix(text, suffix):
     """
@@ -28,8 +43,22 @@ class RepoCloner(ParallelTasks):
     """
     Do the actual work of checking out a git repository to the specifications
     given in the manifest file.
+
+    The work is almost entirely waiting on git subprocesses, so worker threads are
+    used by default rather than forked worker processes.
+
+    Only the first and last output_capture_limit bytes of each git output are kept in the
+    results; longer output is kept in full in output_log_directory under the build directory.
     """
-    def add_task(self, data, name=None):
+    default_backend = BACKEND_THREADS
+    output_capture_limit = config.git_output_capture_limit
+    output_log_directory = ".git-output"
+
+    # lock file, in the git directory of a repository's clone, held while fetching into it
+    # or adding worktrees to it for the repository's other checkouts
+    worktree_lock_file = "reprove-worktrees.lock"
+
+    def add_task(self, data, name=None, depends_on=None, group=None):
         """
         Place data for a specific build into the work queue.  The work is to be done in
         a separate process.   This method will return quickly, as soon as the data is placed
@@ -40,12 +69,19 @@ class RepoCloner(ParallelTasks):
            'credentials': a list of Git credentials in URL:VARIABLE_NAME format
            'repo': a repository entry from a manifest file
            'builddir': the location to check out the repository into
-        :param name: a unique key for used for storing results
+        :param name: a unique key for used for storing results, the directory the repository
+                     is checked out into if None (see task_name)
+        :param depends_on: optional list of task names which must succeed first
+        :param group: the group limiting how many such tasks run at once, the repository
+                      host if None (see get_repository_host)
         :return: nothing
         """
         if data is not None and 'repo' in data and 'repository' in data['repo']:
-            name = data['repo']['repository']
-            super(RepoCloner, self).add_task(data, name)
+            if name is None:
+                name = self.task_name(data['builddir'], data['repo'])
+            if group is None:
+                group = self.get_repository_host(data['repo']['repository'])
+            super(RepoCloner, self).add_task(data, name, depends_on, group)
         else:
             raise ValueError("no repository entry in data: {0}".format(data))
 
@@ -69,6 +105,102 @@ class RepoCloner(ParallelTasks):
         return reset_id
 
 
+    @staticmethod
+    def get_clone_mode(data):
+        """
+        :param data: as for do_one_task, optionally with a 'clone_mode' for every repository
+        :return: the repository's 'clone-mode' if it has one, else the mode for every
+                 repository, else CLONE_FULL
+        """
+        clone_mode = data['repo'].get('clone-mode', data.get('clone_mode') or CLONE_FULL)
+        if clone_mode not in CLONE_MODES:
+            raise ValueError("unknown clone mode '{0}' for {1}".format(clone_mode,
+                                                                    data['repo']['repository']))
+        return clone_mode
+
+
+    @staticmethod
+    def _clone_mode_options(repo, clone_mode, reset_id):
+        """
+        :return: the git clone or fetch options for a clone mode.   A shallow clone which must
+                 then be reset to a commit or tag gets the whole history, as the commit may
+                 not be the tip of the branch.   A sparse checkout only fetches the file
+                 contents it needs, as in the blobless mode, where the server allows it.
+        """
+        options = []
+        if clone_mode == CLONE_SHALLOW and reset_id is None:
+            options.extend(['--depth', '1'])
+        if clone_mode == CLONE_BLOBLESS or 'sparse-paths' in repo:
+            options.append('--filter=blob:none')
+        return options
+
+
+    @staticmethod
+    def _sparse_checkout_command(repo):
+        """
+        :return: the command limiting a checkout to the repository's 'sparse-paths' directories
+                 (and the files at the top of the repository), in cone mode
+        """
+        return ['sparse-checkout', 'set', '--cone'] + list(repo['sparse-paths'])
+
+
+    @classmethod
+    def _sparse_steps(cls, data, results, working_directory):
+        """
+        Step generator making an existing checkout as sparse as the manifest asks: limited to
+        its 'sparse-paths', or, without them, complete.   A worktree starts out with the
+        sparse checkout of the worktree it was added from.
+
+        :param data: as for do_one_task
+        :param results: dictionary for storing results
+        :param working_directory: the checkout
+        :return: None
+        """
+        repo = data['repo']
+        if 'sparse-paths' in repo:
+            command = cls._sparse_checkout_command(repo)
+        else:
+            return_code, out, err = yield (['config', '--get', 'core.sparseCheckout'],
+                                           working_directory)
+            if out is None or out.strip() != "true":
+                return
+            command = ['sparse-checkout', 'disable']
+
+        start_time = datetime.datetime.now()
+        return_code, out, err = yield (command, working_directory)
+        results['commands'].append(cls._command_record(command, start_time, return_code, out, err))
+        if return_code != 0:
+            raise RuntimeError("Unable to change the sparse checkout of {0}".format(working_directory))
+
+
+    @classmethod
+    def _pinned_fetch_commands(cls, repo, reset_id, clone_mode, working_directory):
+        """
+        :return: the (args, directory) of the commands which check out only the pinned commit
+                 or tag of a repository: an empty repository is made, the commit or tag fetched
+                 into it, and checked out on the manifest's branch (detached if there is none)
+        """
+        if reset_id == repo.get('commit-id'):
+            wanted = reset_id
+        else:
+            wanted = "refs/tags/" + reset_id
+
+        # a shallow fetch of the pinned commit itself is the whole point here
+        options = cls._clone_mode_options(repo, clone_mode, None)
+        if 'branch' in repo:
+            checkout = ['checkout', '-q', '-B', repo['branch'], 'FETCH_HEAD']
+        else:
+            checkout = ['checkout', '-q', '--detach', 'FETCH_HEAD']
+
+        commands = [(['init', '-q', working_directory], os.path.dirname(working_directory)),
+                    (['remote', 'add', 'origin', repo['repository']], working_directory)]
+        if 'sparse-paths' in repo:
+            commands.append((cls._sparse_checkout_command(repo), working_directory))
+        commands.extend([(['fetch', '--quiet'] + options + ['origin', wanted], working_directory),
+                         (checkout, working_directory)])
+        return commands
+
+
     def do_one_task(self, name, data, results):
         """
         Perform the actual work of checking out a repository.   This portion of the
@@ -83,6 +215,10 @@ class RepoCloner(ParallelTasks):
            'credentials': a list of Git credentials in URL:VARIABLE_NAME format
            'repo': a repository entry from a manifest file
            'builddir': the location to check out the repository into
+        and may contain:
+           'sync': True to update an existing checkout in place (see checkout_steps)
+           'worktree_of': the directory name of another checkout of the same repository,
+                          to add this one to as a worktree (see find_worktrees)
         :param results: a shared dictionary for storing results and sharing them to the
                         parent process
         :return: None (all output data stored in results)
@@ -92,6 +228,197 @@ class RepoCloner(ParallelTasks):
         if name is None or data is None:
             raise ValueError("name or data not present")
 
+        git = GitBit(verbose=False)
+        if 'credentials' in data and data['credentials']:
+            for credential in data['credentials']:
+                url, cred = credential.split(',', 2)
+                git.add_credential_from_variable(url, cred)
+
+        # git is only run in a session of its own, out of reach of the terminal's prompts and
+        # Ctrl-C, when it may have to be killed: to keep to a time limit, or to stop it once
+        # another checkout has failed
+        deadline = results['task'].get('deadline')
+        cancel = None
+        if self._fail_fast or deadline is not None:
+            cancel = self.get_cancel_event()
+        git.run_steps(self.checkout_steps(data, results), deadline=deadline, cancel=cancel)
+
+
+    def _run_one_task(self, name, data):
+        """
+        Run a task in a worker.   A worker process sends the timings of the git commands it
+        ran back with the results, since its GitBit.command_stats is its own.
+        """
+        results = super(RepoCloner, self)._run_one_task(name, data)
+        if self.get_backend() == BACKEND_PROCESSES:
+            results['git_commands'] = GitBit.command_stats.drain()
+        return results
+
+
+    def _record(self, name, results):
+        """
+        Add the git command timings sent back by a worker process to this process' own
+        """
+        GitBit.command_stats.merge(results.pop('git_commands', []))
+        super(RepoCloner, self)._record(name, results)
+
+
+    def prepare_retry(self, name, data, results):
+        """
+        Remove the partial checkout left by a failed clone, so the clone can be retried.
+        A directory which was already there before the clone is left alone.
+        """
+        if results.get('destination_existed', True):
+            return
+
+        destination = os.path.join(data['builddir'],
+                                   self.get_destination_directory_name(data['repo']))
+        if os.path.isdir(destination):
+            print "Removing partial checkout {0} before retrying".format(destination)
+            shutil.rmtree(destination)
+
+
+    @classmethod
+    def task_name(cls, builddir, repo):
+        """
+        :return: the name under which the checkout of a repository is added by default: the
+                 directory it is checked out into, as the manifest may check out one URL
+                 more than once
+        """
+        return os.path.join(builddir, cls.get_destination_directory_name(repo))
+
+
+    @staticmethod
+    def get_repository_host(repo_url):
+        """
+        :param repo_url: a repository URL, scp-style location (user@host:path) or local path
+        :return: the host serving the repository, or None for a local repository
+        """
+        parsed = urlparse(repo_url)
+        if parsed.hostname:
+            return parsed.hostname
+        if parsed.scheme == '' and ':' in repo_url.split('/')[0]:
+            return repo_url.split(':')[0].rsplit("@", 1)[-1].lower()
+        return None
+
+
+    @classmethod
+    def find_worktrees(cls, repo_list):
+        """
+        Find the repositories which the manifest checks out more than once, so that each is
+        cloned only once.   The first entry for a URL is cloned; every later entry for the
+        same URL, in a different directory, is checked out as a worktree of that clone.
+
+        :param repo_list: the manifest repositories, in the order they are to be checked out
+        :return: dictionary of destination directory name to the directory name of the
+                 clone, for each repository to be checked out as a worktree
+        """
+        clones = {}
+        worktrees = {}
+        for repo in repo_list:
+            directory_name = cls.get_destination_directory_name(repo)
+            clone = clones.setdefault(repo['repository'], directory_name)
+            if clone != directory_name:
+                worktrees[directory_name] = clone
+        return worktrees
+
+
+    @staticmethod
+    def get_destination_directory_name(repo):
+        """
+        :param repo: a specific manifest repository
+        :return: the name of the directory the repository is checked out into
+        """
+        if 'checked-out-directory-name' in repo:
+            return repo['checked-out-directory-name']
+        return strip_suffix(os.path.basename(repo['repository']), ".git")
+
+
+    @staticmethod
+    def _command_record(command, start_time, return_code, out, err, output_info=None):
+        """
+        :param output_info: the output sizes and log files from GitBit.run, if any
+        :return: the entry for results['commands'] describing one finished git command
+        """
+        record = {'command': command,
+                  'return_code': return_code,
+                  'stdout': out,
+                  'stderr': err,
+                  'start_time': start_time,
+                  'end_time': datetime.datetime.now()
+                 }
+        for stream, info in (output_info or {}).items():
+            record[stream + '_bytes'] = info['bytes']
+            record[stream + '_log'] = info['log']
+        return record
+
+
+    @classmethod
+    def _capture_options(cls, data, destination_directory_name, output_info):
+        """
+        :return: the step options (see GitBit.run_steps) bounding the output kept for a command
+        """
+        if cls.output_capture_limit is None:
+            return {}
+        return {'capture_limit': cls.output_capture_limit,
+                'log_dir': os.path.join(data['builddir'], cls.output_log_directory,
+                                        destination_directory_name),
+                'output_info': output_info
+               }
+
+
+    @classmethod
+    def _refresh_mirror_steps(cls, data, results):
+        """
+        Step generator bringing the mirror of a repository up to date, if it hasn't been
+        refreshed yet in this run.   A mirror which can't be refreshed is left as it was;
+        the checkout then takes what it can from it and the rest from the remote.
+
+        Freshness is checked under the shared lock first, so that a mirror which is already
+        fresh doesn't wait for the other checkouts cloning from it; the exclusive lock is
+        only taken to refresh a stale one.
+
+        :param data: as for do_one_task, with 'mirror_cache' set
+        :param results: dictionary for storing results
+        :return: None
+        """
+        mirror_cache = data['mirror_cache']
+        repo_url = data['repo']['repository']
+        with mirror_cache.lock(repo_url, exclusive=False):
+            if mirror_cache.is_fresh(repo_url):
+                return
+
+        with mirror_cache.lock(repo_url, exclusive=True):
+            # another checkout may have refreshed it while this one waited for the lock
+            if mirror_cache.is_fresh(repo_url):
+                return
+
+            command, directory = mirror_cache.refresh_command(repo_url)
+            start_time = datetime.datetime.now()
+            return_code, out, err = yield (command, directory)
+            if return_code == 0:
+                results['commands'].append(cls._command_record(command, start_time,
+                                                               return_code, out, err))
+                mirror_cache.refreshed(repo_url)
+            else:
+                print "Unable to refresh the mirror of {0}, continuing without it: {1}".format(
+                    repo_url, err)
+                mirror_cache.discard(repo_url)
+
+
+    @classmethod
+    def clone_steps(cls, data, results):
+        """
+        Step generator for checking out a single repository (see GitBit.run_steps).
+        Shared by do_one_task and RepoOperator.clone_repo_list_async.
+
+        If data has a 'mirror_cache' (a MirrorCache), the repository's mirror is refreshed
+        first and the clone takes its objects from there.
+
+        :param data: as for do_one_task
+        :param results: dictionary for storing results
+        :return: None (all output data stored in results)
+        """
         for key in ['repo', 'builddir']:
             if key not in data:
                 raise ValueError("{0} key missing from data: {1}".format(key, data))
@@ -102,75 +429,397 @@ class RepoCloner(ParallelTasks):
 
         # data validation okay, so start the work
 
-        print "Starting checkout of {0}".format(name)
+        print "Starting checkout of {0}".format(repo['repository'])
 
         # someplace to start storing results of the commands that will be run
         results['commands'] = []
         commands = results['commands']
-        git = GitBit(verbose=False)
-        if 'credentials' in data:
-            for credential in data['credentials']:
-                url, cred = credential.split(',', 2)
-                git.add_credential_from_variable(url, cred)
         repo_url = repo['repository']
-        destination_directory_name = strip_suffix(os.path.basename(repo_url), ".git")
+        destination_directory_name = cls.get_destination_directory_name(repo)
+        working_directory = os.path.join(data['builddir'], destination_directory_name)
+        results['destination_existed'] = os.path.exists(working_directory)
+        lfs = repo.has_key('lfs') and repo['lfs']
+        reset_id = cls._get_reset_value(repo)
+        clone_mode = cls.get_clone_mode(data)
+
+        # outside the full clone mode, a pinned commit or tag is fetched on its own into an
+        # empty repository, rather than cloning a whole branch and resetting it
+        if clone_mode != CLONE_FULL and reset_id is not None and not lfs and \
+           not results['destination_existed']:
+            for command, directory in cls._pinned_fetch_commands(repo, reset_id, clone_mode,
+                                                                 working_directory):
+                start_time = datetime.datetime.now()
+                output_info = {}
+                return_code, out, err = yield (command, directory,
+                                               cls._capture_options(data, destination_directory_name, output_info))
+                if return_code != 0:
+                    break
+                commands.append(cls._command_record(command, start_time, return_code, out, err, output_info))
+            else:
+                results['status'] = "success"
+                return
+
+            # servers which only allow fetching advertised refs refuse a commit id
+            print "Unable to fetch {0} from {1} on its own, cloning instead: {2}".format(
+                reset_id, repo_url, (err or "").strip())
+            shutil.rmtree(working_directory, ignore_errors=True)
+            del commands[:]
+            if clone_mode == CLONE_SHALLOW:
+                clone_mode = CLONE_FULL
+
         # build up a git clone command line
         # clone [ -b branchname ] repository_url [ destination_name ]
 
         command = ['clone']
 
         #clone big files with git-lfs is much faster
-        if repo.has_key('lfs') and repo['lfs']:
+        if lfs:
             command = ['lfs', 'clone']
 
         if 'branch' in repo:
             command.extend(['-b', repo['branch']])
 
+        command.extend(cls._clone_mode_options(repo, clone_mode, reset_id))
+
+        if 'sparse-paths' in repo:
+            # only the files at the top of the repository are checked out until the paths are set
+            command.append('--sparse')
+
+        # the mirror is locked against refreshes for as long as the clone reads from it
+        mirror_lock = None
+        mirror_cache = data.get('mirror_cache')
+        if mirror_cache is not None:
+            refresh = cls._refresh_mirror_steps(data, results)
+            try:
+                reply = None
+                while True:
+                    try:
+                        step = refresh.send(reply)
+                    except StopIteration:
+                        break
+                    reply = yield step
+            finally:
+                # release the exclusive lock if these steps are closed during the refresh
+                refresh.close()
+            mirror_lock = mirror_cache.lock(repo_url, exclusive=False)
+            mirror_lock.acquire()
+            command.extend(mirror_cache.clone_options(repo_url))
+
         command.append(repo_url)
 
         if 'checked-out-directory-name' in repo:
             # this specifies what the directory name of the checked out repository
             # should be, as opposed to using Git's default (the basename of the repository URL)
 
-            # note to self: do not combine the following two lines again
-            destination_directory_name = repo['checked-out-directory-name']
             command.append(destination_directory_name)
 
-        return_code, out, err = git.run(command, data['builddir'])
-
-        commands.append({'command': command,
-                         'return_code': return_code,
-                         'stdout': out,
-                         'stderr': err
-                        })
+        start_time = datetime.datetime.now()
+        output_info = {}
+        try:
+            return_code, out, err = yield (command, data['builddir'],
+                                           cls._capture_options(data, destination_directory_name, output_info))
+        finally:
+            if mirror_lock is not None:
+                mirror_lock.release()
+        commands.append(cls._command_record(command, start_time, return_code, out, err, output_info))
 
         if return_code != 0:
             raise RuntimeError("Unable to clone the repository")
 
+        if 'sparse-paths' in repo:
+            command = cls._sparse_checkout_command(repo)
+            start_time = datetime.datetime.now()
+            return_code, out, err = yield (command, working_directory)
+            commands.append(cls._command_record(command, start_time, return_code, out, err))
+            if return_code != 0:
+                raise RuntimeError("Unable to set the sparse checkout paths")
+
         # the clone has been performed -- now check to see if we need to move the HEAD
         # to point to a specific location within the tree history.   That will be true
         # if there is a commit-id or tag value specified in the repository (which will
         # be the case most of the time).
 
-        reset_id = self._get_reset_value(repo)
-
         if reset_id is not None:
-            working_directory = os.path.join(data['builddir'], destination_directory_name)
-
             command = ["reset", "--hard", reset_id]
-            return_code, out, err = git.run(command, directory=working_directory)
-            commands.append({'command': command,
-                             'return_code': return_code,
-                             'stdout': out,
-                             'stderr': err
-                            })
+            start_time = datetime.datetime.now()
+            output_info = {}
+            return_code, out, err = yield (command, working_directory,
+                                           cls._capture_options(data, destination_directory_name, output_info))
+            commands.append(cls._command_record(command, start_time, return_code, out, err, output_info))
             if return_code != 0:
                 raise RuntimeError("unable to move to correct commit/tag")
 
         results['status'] = "success"
 
 
+    @classmethod
+    def checkout_steps(cls, data, results):
+        """
+        :param data: as for do_one_task
+        :param results: dictionary for storing results
+        :return: the step generator for checking out a repository: sync_steps if data has
+                 'sync' set and the repository's directory exists, otherwise clone_steps
+        """
+        destination = os.path.join(data['builddir'], cls.get_destination_directory_name(data['repo']))
+        if data.get('sync') and os.path.isdir(destination):
+            return cls.sync_steps(data, results)
+        if data.get('worktree_of'):
+            return cls.worktree_steps(data, results)
+        return cls.clone_steps(data, results)
+
+
+    @classmethod
+    def _worktree_lock(cls, data):
+        """
+        :return: a FileLock on the clone which a worktree checkout belongs to, or None if the
+                 checkout isn't a worktree
+        """
+        if not data.get('worktree_of'):
+            return None
+        git_dir = RefReader.find_git_dir(os.path.join(data['builddir'], data['worktree_of']))
+        if git_dir is None:
+            raise RuntimeError("There is no clone of {0} in {1}".format(data['repo']['repository'],
+                                                                      data['worktree_of']))
+        return FileLock(os.path.join(git_dir, cls.worktree_lock_file), exclusive=True)
+
+
+    @classmethod
+    def _fetch_steps(cls, data, results, working_directory, reset_id):
+        """
+        Step generator fetching the pinned commit, the pinned tag, or else the tip of the
+        branch into an existing repository (see _sync_fetch)
+
+        :param data: as for do_one_task
+        :param results: dictionary for storing results
+        :param working_directory: the repository to fetch into
+        :param reset_id: the pinned commit or tag, if any
+        :return: None
+        """
+        repo = data['repo']
+        destination_directory_name = cls.get_destination_directory_name(repo)
+        clone_mode = cls.get_clone_mode(data)
+        command, target = cls._sync_fetch(repo, reset_id, clone_mode)
+        start_time = datetime.datetime.now()
+        output_info = {}
+        return_code, out, err = yield (command, working_directory,
+                                       cls._capture_options(data, destination_directory_name, output_info))
+        if return_code != 0 and target == reset_id:
+            # servers which only allow fetching advertised refs refuse a commit id, so fetch
+            # everything in the hope of finding it
+            print "Unable to fetch {0} from {1} on its own, fetching all refs instead: {2}".format(
+                reset_id, repo['repository'], (err or "").strip())
+            command = ['fetch', '--quiet', '--tags'] + \
+                      cls._clone_mode_options(repo, clone_mode, None) + ['origin']
+            start_time = datetime.datetime.now()
+            output_info = {}
+            return_code, out, err = yield (command, working_directory,
+                                           cls._capture_options(data, destination_directory_name, output_info))
+        results['commands'].append(cls._command_record(command, start_time, return_code, out, err,
+                                                       output_info))
+        if return_code != 0:
+            raise RuntimeError("Unable to fetch the repository")
+
+
+    @classmethod
+    def worktree_steps(cls, data, results):
+        """
+        Step generator for checking out a repository as a worktree of another checkout of the
+        same URL (see GitBit.run_steps and find_worktrees).   The pinned commit or tag, or the
+        tip of the branch, is fetched into the clone first if it isn't there already.
+
+        The worktree is detached at that commit, since a branch can only be checked out in
+        one worktree at a time.
+
+        :param data: as for do_one_task, with 'worktree_of' set
+        :param results: dictionary for storing results
+        :return: None (all output data stored in results)
+        """
+        repo = data['repo']
+        destination_directory_name = cls.get_destination_directory_name(repo)
+        working_directory = os.path.join(data['builddir'], destination_directory_name)
+        clone_directory = os.path.join(data['builddir'], data['worktree_of'])
+
+        print "Starting checkout of {0} as a worktree of {1}".format(repo['repository'],
+                                                                     clone_directory)
+
+        results['commands'] = []
+        commands = results['commands']
+        results['destination_existed'] = os.path.exists(working_directory)
+
+        reset_id = cls._get_reset_value(repo)
+        target = cls._sync_fetch(repo, reset_id, cls.get_clone_mode(data))[1]
+
+        # the other worktrees of the clone may be fetching into it, or adding themselves
+        with cls._worktree_lock(data):
+            command = ['rev-parse', '--verify', '--quiet', target + '^{commit}']
+            return_code, out, err = yield (command, clone_directory)
+            if return_code != 0:
+                fetch = cls._fetch_steps(data, results, clone_directory, reset_id)
+                reply = None
+                while True:
+                    try:
+                        step = fetch.send(reply)
+                    except StopIteration:
+                        break
+                    reply = yield step
+
+            # forget any worktree of the clone whose directory has been removed, such as
+            # a partial checkout of this one which is being retried
+            yield (['worktree', 'prune'], clone_directory)
+
+            # a sparse worktree is only filled in once its paths are set
+            command = ['worktree', 'add', '--detach', working_directory, target]
+            if 'sparse-paths' in repo:
+                command[2:2] = ['--no-checkout']
+            start_time = datetime.datetime.now()
+            output_info = {}
+            return_code, out, err = yield (command, clone_directory,
+                                           cls._capture_options(data, destination_directory_name, output_info))
+            commands.append(cls._command_record(command, start_time, return_code, out, err, output_info))
+            if return_code != 0:
+                raise RuntimeError("Unable to add the worktree")
+
+        sparse = cls._sparse_steps(data, results, working_directory)
+        reply = None
+        while True:
+            try:
+                step = sparse.send(reply)
+            except StopIteration:
+                break
+            reply = yield step
+
+        if 'sparse-paths' in repo:
+            command = ['checkout', '-q', '-f', 'HEAD']
+            start_time = datetime.datetime.now()
+            output_info = {}
+            return_code, out, err = yield (command, working_directory,
+                                           cls._capture_options(data, destination_directory_name, output_info))
+            commands.append(cls._command_record(command, start_time, return_code, out, err, output_info))
+            if return_code != 0:
+                raise RuntimeError("Unable to check out the worktree")
+
+        results['status'] = "success"
+
+
+    @classmethod
+    def _sync_fetch(cls, repo, reset_id, clone_mode):
+        """
+        :return: (fetch command, reset target) for bringing an existing checkout up to date:
+                 the pinned commit, the pinned tag, or else the tip of the branch, fetched
+                 on its own
+        """
+        fetch = ['fetch', '--quiet'] + cls._clone_mode_options(repo, clone_mode, None) + ['origin']
+        if reset_id is not None and reset_id == repo.get('commit-id'):
+            return fetch + [reset_id], reset_id
+        if reset_id is not None:
+            tag_ref = "refs/tags/" + reset_id
+            return fetch + ["+{0}:{0}".format(tag_ref)], tag_ref
+        if 'branch' in repo:
+            remote_ref = "refs/remotes/origin/" + repo['branch']
+            return fetch + ["+refs/heads/{0}:{1}".format(repo['branch'], remote_ref)], remote_ref
+        return fetch + ['HEAD'], 'FETCH_HEAD'
+
+
+    @classmethod
+    def sync_steps(cls, data, results):
+        """
+        Step generator for bringing an existing checkout of a repository to the specifications
+        given in the manifest, in place (see GitBit.run_steps).
+
+        A checkout already on the pinned commit or tag (and on the manifest's branch, if it
+        names one) is left alone; a tag found locally is trusted.   Otherwise the commit, tag
+        or branch is fetched and checked out, discarding any local changes to tracked files.
+
+        :param data: as for do_one_task
+        :param results: dictionary for storing results; 'sync' is set to "unchanged" or "updated"
+        :return: None (all output data stored in results)
+        """
+        repo = data['repo']
+        repo_url = repo['repository']
+        destination_directory_name = cls.get_destination_directory_name(repo)
+        working_directory = os.path.join(data['builddir'], destination_directory_name)
+
+        print "Starting sync of {0} in {1}".format(repo_url, working_directory)
+
+        results['commands'] = []
+        commands = results['commands']
+        results['destination_existed'] = True
+
+        if RefReader.find_git_dir(working_directory) is None:
+            raise RuntimeError("{0} is not a git checkout".format(working_directory))
+
+        # the sparse paths may have changed even if the commit hasn't
+        sparse = cls._sparse_steps(data, results, working_directory)
+        reply = None
+        while True:
+            try:
+                step = sparse.send(reply)
+            except StopIteration:
+                break
+            reply = yield step
+
+        # a worktree of another checkout is kept detached, as the branch is checked out there
+        on_branch = 'branch' in repo and not data.get('worktree_of')
+        reader = RefReader(working_directory)
+        reset_id = cls._get_reset_value(repo)
+        if reset_id is not None and (not on_branch or reader.current_branch() == repo['branch']):
+            command = ['rev-parse', '--verify', '--quiet', reset_id + '^{commit}']
+            return_code, out, err = yield (command, working_directory)
+            if return_code == 0 and out.strip() == reader.head_commit():
+                print "{0} is already at {1}".format(working_directory, reset_id)
+                results['sync'] = "unchanged"
+                results['status'] = "success"
+                return
+
+        # the manifest's URL may have changed, or been remapped, since the checkout was made
+        command = ['config', '--get', 'remote.origin.url']
+        return_code, out, err = yield (command, working_directory)
+        if return_code != 0 or out.strip() != repo_url:
+            command = ['remote', 'set-url' if return_code == 0 else 'add', 'origin', repo_url]
+            start_time = datetime.datetime.now()
+            return_code, out, err = yield (command, working_directory)
+            commands.append(cls._command_record(command, start_time, return_code, out, err))
+            if return_code != 0:
+                raise RuntimeError("Unable to set the origin of {0}".format(working_directory))
+
+        target = cls._sync_fetch(repo, reset_id, cls.get_clone_mode(data))[1]
+
+        # a worktree shares its refs and objects with the clone's other worktrees
+        worktree_lock = cls._worktree_lock(data)
+        if worktree_lock is not None:
+            worktree_lock.acquire()
+        try:
+            fetch = cls._fetch_steps(data, results, working_directory, reset_id)
+            reply = None
+            while True:
+                try:
+                    step = fetch.send(reply)
+                except StopIteration:
+                    break
+                reply = yield step
+
+            if on_branch:
+                command = ['checkout', '-q', '-f', '-B', repo['branch'], target]
+            else:
+                command = ['checkout', '-q', '-f', '--detach', target]
+            start_time = datetime.datetime.now()
+            output_info = {}
+            return_code, out, err = yield (command, working_directory,
+                                           cls._capture_options(data, destination_directory_name, output_info))
+        finally:
+            if worktree_lock is not None:
+                worktree_lock.release()
+        commands.append(cls._command_record(command, start_time, return_code, out, err, output_info))
+        if return_code != 0:
+            raise RuntimeError("unable to move to correct commit/tag")
+
+        results['sync'] = "updated"
+        results['status'] = "success"
+
+
 class RepoOperator(object):
+    # remote branches and tags, shared by all instances so each remote is listed once per run
+    remote_refs = RemoteRefsCache(config.remote_refs_ttl, config.remote_refs_cache_file)
 
     def __init__(self, git_credentials=None):
         """
@@ -179,7 +828,12 @@ class RepoOperator(object):
         :return:
         """
         self._git_credentials = git_credentials
-        
+        self._cloner = None
+        self._cloner_config = None
+        self._task_trace = None
+        self._queries = {}
+        self._queries_lock = threading.Lock()
+
         self.git = GitBit(verbose=True)
         if self._git_credentials:
             self.setup_gitbit()
@@ -202,6 +856,66 @@ class RepoOperator(object):
             url, cred = url_cred_pair.split(',')
             self.git.add_credential_from_variable(url, cred)
 
+    def close(self):
+        """
+        Stop the workers kept for clone_repo_list and the processes kept for repository queries
+        :return: None
+        """
+        if self._cloner is not None:
+            self._cloner.close()
+            self._cloner = None
+            self._cloner_config = None
+
+        with self._queries_lock:
+            queries = self._queries.values()
+            self._queries = {}
+        for query in queries:
+            query.close()
+
+
+    def get_query(self, repo_dir):
+        """
+        Return the GitQuery for a repository, which is kept until close() so that repeated
+        lookups in the same repository share one set of git processes
+        :param repo_dir: path of the repository
+        :return: GitQuery
+        """
+        if repo_dir is None or not os.path.isdir(repo_dir):
+            raise RuntimeError("The repository directory is not a directory")
+
+        key = os.path.realpath(repo_dir)
+        with self._queries_lock:
+            query = self._queries.get(key)
+            if query is None:
+                query = GitQuery(self.git, repo_dir)
+                self._queries[key] = query
+        return query
+
+
+    def _get_cloner(self, jobs, backend, timeout, retries, host_jobs, fail_fast):
+        """
+        Return a RepoCloner with the given settings.   The workers are kept between
+        calls, so repeated clones don't pay the worker startup cost again.
+        """
+        settings = (jobs, backend, timeout, retries, host_jobs, fail_fast)
+        if self._cloner is not None and self._cloner_config != settings:
+            self.close()
+        if self._cloner is None:
+            self._cloner = RepoCloner(jobs, backend=backend, task_timeout=timeout, retries=retries,
+                                      group_limits=host_jobs, fail_fast=fail_fast)
+            self._cloner_config = settings
+        return self._cloner
+
+
+    def set_task_trace(self, task_trace):
+        """
+        Record the timing of every checkout done by clone_repo_list
+        :param task_trace: a TaskTrace, or None to stop recording
+        :return: None
+        """
+        self._task_trace = task_trace
+
+
     def set_git_dryrun(self, dryrun):
         self.git.set_dryrun(dryrun)
     
@@ -244,7 +958,10 @@ class RepoOperator(object):
 
         return error_found
 
-    def clone_repo_list(self, repo_list, dest_dir, jobs=1):
+    def clone_repo_list(self, repo_list, dest_dir, jobs=1, backend=None, timeout=None, retries=0,
+                        history_file=config.task_history_file, host_jobs=config.host_job_limits,
+                        fail_fast=False, mirror_cache=config.mirror_cache_directory,
+                        clone_mode=config.clone_mode):
         """
         check out repository to dest dir based on repo list
         :param repo_list: a list of repository entry which should contain:
@@ -252,28 +969,118 @@ class RepoOperator(object):
                           'branch': the branch to be check out, it is optional
                           'commit-id': the commit id to be reset, it is optional
         :param dest_dir: the directory where repository will be check out
-        :param jobs: Number of parallel jobs to run
+        :param jobs: Number of parallel jobs to run, or 'auto' to tune it while running
+        :param backend: ParallelTasks execution backend ('processes', 'threads' or 'inline');
+                        None uses the RepoCloner default
+        :param timeout: seconds allowed for each attempt at checking out a repository, None for no limit
+        :param retries: how many times to retry a failed checkout
+        :param history_file: where checkout durations are remembered, so the repositories
+                             expected to take longest can be started first.  None to disable
+        :param host_jobs: the most checkouts to run at once from each host, by host name
+                          ('*' for any other host); hosts not given are only limited by jobs
+        :param fail_fast: if True, the first failed checkout cancels the others: checkouts not
+                          yet started are skipped and running git commands are killed.
+                          Otherwise every checkout is run to completion
+        :param mirror_cache: directory of bare mirrors to take objects from, refreshing each
+                             one first (see MirrorCache).  None to clone from the remotes only
+        :param clone_mode: CLONE_FULL, CLONE_SHALLOW or CLONE_BLOBLESS, for the repositories
+                           without a 'clone-mode' of their own
+        A URL listed more than once is cloned once, and its other entries checked out as
+        worktrees of that clone (see RepoCloner.find_worktrees).   The results are reported
+        by the directory each repository is checked out into.
         :return:
         """
-        cloner = RepoCloner(jobs)
+        if mirror_cache is not None:
+            mirror_cache = MirrorCache(mirror_cache)
+
+        history = None
+        if history_file is not None:
+            history = TaskHistory(history_file)
+            repo_list = history.longest_first(repo_list, lambda repo: repo['repository'])
+
+        # each URL is cloned once; its other checkouts are added to that clone as worktrees
+        worktrees = RepoCloner.find_worktrees(repo_list)
+        clones = {}
+
+        cloner = self._get_cloner(jobs, backend, timeout, retries, host_jobs, fail_fast)
         if cloner is not None:
             for repo in repo_list:
+                directory_name = RepoCloner.get_destination_directory_name(repo)
                 data = {'repo': repo,
                         'builddir': dest_dir,
-                        'credentials': self._git_credentials
+                        'credentials': self._git_credentials,
+                        'mirror_cache': mirror_cache,
+                        'clone_mode': clone_mode,
+                        'worktree_of': worktrees.get(directory_name)
                        }
 
-                cloner.add_task(data)
-            cloner.finish()
-            results = cloner.get_results()
+                depends_on = None
+                if directory_name in worktrees:
+                    depends_on = [os.path.join(dest_dir, worktrees[directory_name])]
+                else:
+                    clones[RepoCloner.task_name(dest_dir, repo)] = repo['repository']
+                cloner.add_task(data, depends_on=depends_on)
 
+            # report on each repository as soon as it is done
             error = False
-            for name in results.keys():
-                error |= self.print_command_summary(name, results)
+            for name, result in cloner.as_completed():
+                if self._task_trace is not None:
+                    self._task_trace.add_task(name, result)
+                error |= self.print_command_summary(name, {name: result})
+                if result.get('status') != 'success':
+                    error = True
+                    if 'exception' in result:
+                        print "ERROR: {0}".format(result['exception'])
+                elif history is not None and name in clones:
+                    history.record(clones[name], cloner.last_attempt_seconds(result))
+
+            if history is not None:
+                history.save()
 
             if error:
                 raise RuntimeError("Failed to clone repositories")
 
+
+    def _run_command_loop(self, loop, message):
+        """
+        Run a GitCommandLoop, print the command summaries and raise if anything failed
+        :param loop: the populated GitCommandLoop
+        :param message: the RuntimeError message used when any work failed
+        :return: the loop results, keyed by name
+        """
+        results = loop.run()
+
+        error = False
+        for name in results.keys():
+            error |= self.print_command_summary(name, results)
+            if results[name].get('status') != 'success':
+                error = True
+                if 'exception' in results[name]:
+                    print "ERROR: {0}".format(results[name]['exception'])
+
+        if error:
+            raise RuntimeError(message)
+        return results
+
+
+    def clone_repo_list_async(self, repo_list, dest_dir, max_children=64):
+        """
+        check out repository to dest dir based on repo list, supervising every
+        git child from a single GitCommandLoop instead of a pool of workers
+        :param repo_list: as for clone_repo_list
+        :param dest_dir: the directory where repository will be check out
+        :param max_children: the most git processes to run at once
+        :return: the clone results, keyed by checkout directory (see RepoCloner.task_name), as
+                 the manifest may check out one URL more than once
+        """
+        loop = GitCommandLoop(self.git, max_children)
+        for repo in repo_list:
+            data = {'repo': repo,
+                    'builddir': dest_dir
+                   }
+            loop.add(RepoCloner.task_name(dest_dir, repo), RepoCloner.clone_steps, data)
+        return self._run_command_loop(loop, "Failed to clone repositories")
+
     
     def clone_repo(self, repo_url, dest_dir):
         """
@@ -296,13 +1103,12 @@ class RepoOperator(object):
         :return: commit-id
         """
          
-        if repo_dir is None or not os.path.isdir(repo_dir):
-            raise RuntimeError("The repository directory is not a directory")
-
-        code, output, error = self.git.run(['log', '--format=format:%H', '-n', '1'], directory=repo_dir)
+        commit_id = RefReader(repo_dir).head_commit()
+        if commit_id is None:
+            commit_id = self.get_query(repo_dir).object_id("HEAD^{commit}")
 
-        if code == 0:
-            return output.strip()
+        if commit_id is not None:
+            return commit_id
         else:
             raise RuntimeError("Unable to get commit id in directory {0}".format(repo_dir))
 
@@ -314,13 +1120,10 @@ class RepoOperator(object):
         :return: commit-message
         """
 
-        if repo_dir is None or not os.path.isdir(repo_dir):
-            raise RuntimeError("The repository directory is not a directory")
+        message = self.get_query(repo_dir).commit_message(commit)
 
-        code, output, error = self.git.run(['log', '--format=format:%B', '-n', '1', commit], directory=repo_dir)
-
-        if code == 0:
-            return output.strip()
+        if message is not None:
+            return message.strip()
         else:
             raise RuntimeError("Unable to get commit message of {commit_id} in directory {repo_dir}"\
                   .format(commit_id=commit, repo_dir=repo_dir))
@@ -353,6 +1156,10 @@ class RepoOperator(object):
         if repo_dir is None or not os.path.isdir(repo_dir):
             raise RuntimeError("The repository directory is not a directory")
 
+        branch = RefReader(repo_dir).current_branch()
+        if branch is not None:
+            return branch
+
         code, output, error = self.git.run(['symbolic-ref', '--short', 'HEAD'], directory=repo_dir)
 
         if code == 0:
@@ -365,6 +1172,7 @@ class RepoOperator(object):
         Checks if the specified branch name exists for the provided repository. Leave only the characters
         following the final "/". This is to handle remote repositories.
         Raise RuntimeError if it is not found.
+        The remote's branches are looked up in remote_refs, so repeated checks don't each ask the remote.
         :return: None
         """
         if "/" in branch:
@@ -372,10 +1180,7 @@ class RepoOperator(object):
         else:
             sliced_branch = branch
 
-        cmd_returncode, cmd_value, cmd_error = self.git.run(['ls-remote', repo_url, 'heads/*{0}'
-                                                                    .format(sliced_branch)])
-
-        if cmd_returncode is not 0 or cmd_value is '':
+        if not self.remote_refs.matching(self.git, repo_url, 'heads/*{0}'.format(sliced_branch)):
             raise RuntimeError("The branch, '{0}', provided for '{1}', does not exist."
                                .format(branch, repo_url))
 
@@ -387,44 +1192,113 @@ class RepoOperator(object):
         :param tag_name: the tag name to be set
         :return: None
         """
+        query = self.get_query(repo_dir)
+        self.git.run_steps(self._tag_steps(repo_url, repo_dir, tag_name, query=query))
+        self.remote_refs.record(repo_url, "refs/tags/" + tag_name, query.object_id("refs/tags/" + tag_name))
+
+
+    @staticmethod
+    def _tag_steps(repo_url, repo_dir, tag_name, results=None, query=None):
+        """
+        Step generator for set_repo_tagname (see GitBit.run_steps)
+
+        :param query: a GitQuery for repo_dir, used to look for the tag instead of 'git tag -l'
+        """
         # See if that tag exists for the repo
-        cmd_returncode, cmd_value, cmd_error  = self.git.run(["tag", "-l", tag_name], repo_dir)
+        if query is not None:
+            cmd_returncode = 0
+            cmd_value = tag_name if query.ref_exists("refs/tags/" + tag_name) else ''
+        else:
+            cmd_returncode, cmd_value, cmd_error  = yield ["tag", "-l", tag_name], repo_dir
 
         # Raise RuntimeError if tag already exists, otherwise create it
         if cmd_returncode == 0 and cmd_value != '':
             raise RuntimeError("Error: Tag {0} already exists - exiting now...".format(cmd_value))
         else:
             print "Creating tag {0} for repo {1}".format(tag_name, repo_url)
-            self.git.run(["tag", "-a", tag_name, "-m", "\"Creating new tag\""], repo_dir)
-            self.git.run(["push", "origin", "--tags"], repo_dir)
+            yield ["tag", "-a", tag_name, "-m", "\"Creating new tag\""], repo_dir
+            yield ["push", "origin", "--tags"], repo_dir
+
+
+    def set_repo_tagname_async(self, repo_dirs, tag_name, max_children=64):
+        """
+        Sets tagname on many repos at once from a single GitCommandLoop
+        :param repo_dirs: a list of (repository url, repository directory) pairs
+        :param tag_name: the tag name to be set
+        :param max_children: the most git processes to run at once
+        :return: the results, keyed by repository directory
+        """
+        loop = GitCommandLoop(self.git, max_children)
+        for repo_url, repo_dir in repo_dirs:
+            loop.add(repo_dir, self._tag_steps, repo_url, repo_dir, tag_name)
+        return self._run_command_loop(loop, "Failed to tag repositories")
 
 
-    def create_repo_branch(self, repo_url, repo_dir, branch_name):
+    def create_repo_branch(self, repo_url, repo_dir, branch_name, publish=True):
         """
         Creates branch on the repo
         :param repo_url: the url of the repository
         :param repo_dir: the directory of the repository
         :param branch_name: the branch name to be set
+        :param publish: also push the branch to the remote; if False, the branch is only
+                        created locally, to be published by push_repo_changes
         :return: None
         """
+        existing = self.remote_refs.matching(self.git, repo_url, "heads/" + branch_name)
+        self.git.run_steps(self._branch_steps(repo_url, repo_dir, branch_name, existing=existing,
+                                              publish=publish))
+        if publish:
+            self.remote_refs.record(repo_url, "refs/heads/" + branch_name,
+                                    self.get_query(repo_dir).object_id("refs/heads/" + branch_name))
+
+
+    @staticmethod
+    def _branch_steps(repo_url, repo_dir, branch_name, results=None, existing=None, publish=True):
+        """
+        Step generator for create_repo_branch (see GitBit.run_steps)
+
+        :param existing: the remote refs already known to match branch_name; if None,
+                         the remote is asked with 'git ls-remote'
+        :param publish: push the new branch to the remote
+        """
         # See if that branch exists for the repo
-        cmd_returncode, cmd_value, cmd_error  = self.git.run(["ls-remote", "--exit-code", "--heads", repo_url, branch_name], repo_dir)
+        if existing is not None:
+            cmd_returncode = 0
+            cmd_value = "\n".join(existing)
+        else:
+            cmd_returncode, cmd_value, cmd_error  = yield ["ls-remote", "--exit-code", "--heads", repo_url, branch_name], repo_dir
 
         # Raise RuntimeError if branch already exists, otherwise create it
         if cmd_returncode == 0 and cmd_value != '':
             raise RuntimeError("Error: Branch {0} already exists - exiting now...".format(cmd_value))
         else:
             print "Creating branch {0} for repo {1}".format(branch_name, repo_url)
-            branch_code, branch_out, branch_error = self.git.run(["branch", branch_name], repo_dir)
+            branch_code, branch_out, branch_error = yield ["branch", branch_name], repo_dir
             if branch_code != 0:
                 print branch_out
                 raise RuntimeError("Error: Failed to create local branch {0} with error: {1}- exiting now...".format(branch_name, branch_error))
-                
-            publish_code, publish_out, publish_error = self.git.run(["push", "-u", "origin", branch_name], repo_dir)
+
+            if not publish:
+                return
+            publish_code, publish_out, publish_error = yield ["push", "-u", "origin", branch_name], repo_dir
             if publish_code != 0:
                 print publish_out
                 raise RuntimeError("Error: Failed to publish local branch {0} with error: {1}- exiting now...".format(branch_name, publish_error))
 
+
+    def create_repo_branch_async(self, repo_dirs, branch_name, max_children=64):
+        """
+        Creates branch on many repos at once from a single GitCommandLoop
+        :param repo_dirs: a list of (repository url, repository directory) pairs
+        :param branch_name: the branch name to be set
+        :param max_children: the most git processes to run at once
+        :return: the results, keyed by repository directory
+        """
+        loop = GitCommandLoop(self.git, max_children)
+        for repo_url, repo_dir in repo_dirs:
+            loop.add(repo_dir, self._branch_steps, repo_url, repo_dir, branch_name)
+        return self._run_command_loop(loop, "Failed to create branches")
+
     def checkout_repo_branch(self, repo_url, repo_dir, branch_name):
         """
         Check out to specify branch on the repo
@@ -438,36 +1312,46 @@ class RepoOperator(object):
         if cmd_returncode != 0:
             raise RuntimeError("Error: Failed to checkout branch {0}  - exiting now...".format(cmd_value))
 
-    def push_repo_changes(self, repo_url, repo_dir, commit_message):
+    def push_repo_changes(self, repo_url, repo_dir, commit_message, branch_name=None):
         """
         publish changes of reposioty
         :param repo_url: the url of the repository
         :param repo_dir: the directory of the repository
         :param commit_message: the message to be added to commit
+        :param branch_name: a branch made by create_repo_branch(publish=False), pushed to the
+                            remote and tracked even if nothing has changed in it
         :return: None
         """
 
         status_code, status_out, status_error = self.git.run(['status'], repo_dir)
-        if status_code == 0:
-            if "nothing to commit, working directory clean" in status_out:
-                print status_out
+        # older git says "working directory clean", newer "working tree clean"
+        if status_code == 0 and "nothing to commit" in status_out:
+            print status_out
+            if branch_name is None:
                 return
+        else:
+            add_code, add_out, add_error = self.git.run(['add', '-u'], repo_dir)
 
-        add_code, add_out, add_error = self.git.run(['add', '-u'], repo_dir)
-
-        if add_code != 0:
-            raise RuntimeError('Unable to add files for commiting.\n{0}\n{1}\n{2}'.format\
-                                 (add_code, add_out, add_error))
+            if add_code != 0:
+                raise RuntimeError('Unable to add files for commiting.\n{0}\n{1}\n{2}'.format\
+                                     (add_code, add_out, add_error))
 
 
-        commit_code, commit_out, commit_error = self.git.run(['commit', '-m', commit_message], repo_dir)
-        if commit_code != 0:
-            raise RuntimeError('Unable to commit changes for pushing.\n{0}\n{1}\n{2}'.format\
-                                 (commit_code, commit_out, commit_error))
+            commit_code, commit_out, commit_error = self.git.run(['commit', '-m', commit_message], repo_dir)
+            if commit_code != 0:
+                raise RuntimeError('Unable to commit changes for pushing.\n{0}\n{1}\n{2}'.format\
+                                     (commit_code, commit_out, commit_error))
 
-        push_code, push_out, push_error = self.git.run(['push'], repo_dir)
+        push_args = ['push']
+        if branch_name is not None:
+            push_args = ['push', '-u', 'origin', branch_name]
+        push_code, push_out, push_error = self.git.run(push_args, repo_dir)
         if push_code !=0:
             raise RuntimeError('Unable to push changes.\n{0}\n{1}\n{2}'.format(push_code, push_out, push_error))
+
+        if branch_name is not None:
+            self.remote_refs.record(repo_url, "refs/heads/" + branch_name,
+                                    self.get_query(repo_dir).object_id("refs/heads/" + branch_name))
         return
 
 
@@ -0,0 +1,104 @@
+# Copyright 2016, EMC, Inc.
+
+"""
+Module to record which repositories in a build directory have been checked out completely,
+so that an interrupted checkout can be resumed instead of started over.
+
+"""
+
+import json
+import os
+
+from git_refs import RefReader
+
+
+class CheckoutJournal(object):
+    """
+    An append-only journal, kept in the build directory, of the checkouts which completed.
+
+    Each completed checkout adds one JSON line: the repository URL, the directory, what the
+    manifest asked for (branch, tag and commit-id) and the commit verified at HEAD.   Every line
+    is flushed to disk as it is written, so after a crash the journal lists exactly the
+    checkouts which finished; a partly written last line is ignored.
+    """
+
+    filename = ".reprove-journal"
+
+    # the manifest keys which decide what a checkout contains
+    requested_keys = ('branch', 'tag', 'commit-id', 'checked-out-directory-name',
+                      'sparse-paths')
+
+    def __init__(self, builddir):
+        """
+        :param builddir: the build directory the repositories are checked out into
+        """
+        self._path = os.path.join(builddir, self.filename)
+        self._entries = {}
+        self.load()
+
+
+    def load(self):
+        """
+        Read the journal.   A missing journal just means nothing has been completed.
+        :return: None
+        """
+        self._entries = {}
+        if not os.path.isfile(self._path):
+            return
+
+        with open(self._path, "r") as journal_file:
+            for line in journal_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the last line may have been cut short by a crash
+                    continue
+                if isinstance(entry, dict) and 'directory' in entry:
+                    self._entries[entry['directory']] = entry
+
+
+    @classmethod
+    def _requested(cls, repo):
+        """
+        :return: the parts of a manifest repository entry which decide what is checked out
+        """
+        return dict((key, repo[key]) for key in cls.requested_keys if key in repo)
+
+
+    def record(self, repo, directory, commit):
+        """
+        Note a completed checkout
+        :param repo: the manifest repository entry
+        :param directory: where it was checked out
+        :param commit: the commit verified at HEAD
+        :return: None
+        """
+        entry = {'repository': repo['repository'],
+                 'directory': os.path.abspath(directory),
+                 'requested': self._requested(repo),
+                 'commit': commit
+                }
+        with open(self._path, "a") as journal_file:
+            journal_file.write(json.dumps(entry, sort_keys=True) + "\n")
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        self._entries[entry['directory']] = entry
+
+
+    def is_complete(self, repo, directory):
+        """
+        Decide whether a checkout can be skipped: the journal must show it completed for the
+        same URL and manifest entry, and HEAD must still be at the commit recorded then.
+
+        :param repo: the manifest repository entry
+        :param directory: where it is checked out
+        :return: the verified commit if the checkout is complete, otherwise None
+        """
+        entry = self._entries.get(os.path.abspath(directory))
+        if entry is None:
+            return None
+        if entry['repository'] != repo['repository'] or entry['requested'] != self._requested(repo):
+            return None
+        if RefReader(directory).head_commit() != entry['commit']:
+            return None
+        return entry['commit']
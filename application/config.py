@@ -1,4 +1,33 @@
+import os
+
 gitbit_identity = dict(
     username='Robbie the Build Robot',
     email='robot@hwimo.lab.emc.com'
 )
+
+# where the durations of previous checkouts are kept, for scheduling the longest first
+task_history_file = os.path.join(os.path.expanduser('~'), '.manifest-build-tools', 'task_history.json')
+
+# how long, in seconds, the branches and tags listed from a remote are trusted
+remote_refs_ttl = 300
+
+# where those lists are kept between runs; None keeps them for the run only
+remote_refs_cache_file = None
+
+# the most checkouts (or other per-repository steps) to run at once against each git host,
+# such as {'github.com': 8}; '*' sets the limit for any host not named
+host_job_limits = {}
+
+# seconds an idle shared SSH connection is kept open, with --ssh-multiplex
+ssh_control_persist = 60
+
+# directory of bare mirrors which checkouts take their objects from; None to clone from
+# the remotes only
+mirror_cache_directory = None
+
+# how much of each repository a checkout fetches, unless its manifest entry has a
+# 'clone-mode': 'full', 'shallow' (--depth 1) or 'blobless' (--filter=blob:none)
+clone_mode = 'full'
+
+# bytes kept from each end of a checkout's git output; the rest is only kept in a log file
+git_output_capture_limit = 32 * 1024
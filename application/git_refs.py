@@ -0,0 +1,169 @@
+# Copyright 2016, EMC, Inc.
+
+"""
+Module to answer simple ref questions ("which branch is checked out", "which commit is HEAD")
+by reading a repository's .git directory directly, without starting git.
+
+Only the plain files backend is understood: HEAD, loose refs and packed-refs.   Anything else
+(reftable repositories, unborn branches, damaged files) gives None, and the caller should ask
+git instead.
+
+"""
+
+import os
+import re
+
+OBJECT_ID = re.compile(r"^([0-9a-f]{40}|[0-9a-f]{64})$")
+
+# symbolic refs pointing at symbolic refs are followed this many times at most, as git does
+MAX_SYMREF_DEPTH = 5
+
+
+class RefReader(object):
+    """
+    Read refs from one repository's git directory
+    """
+
+    def __init__(self, repo_dir):
+        """
+        :param repo_dir: the working tree (or bare repository) to read
+        """
+        self._git_dir = self.find_git_dir(repo_dir)
+        self._common_dir = self._git_dir
+        if self._git_dir is not None:
+            # linked worktrees keep their own HEAD, but share the refs of the main repository
+            common = self._read_file(os.path.join(self._git_dir, "commondir"))
+            if common is not None:
+                self._common_dir = os.path.normpath(os.path.join(self._git_dir, common))
+            if os.path.isdir(os.path.join(self._common_dir, "reftable")):
+                # refs are in the binary reftable format, and HEAD is only a placeholder
+                self._git_dir = None
+
+
+    @staticmethod
+    def _read_file(filename):
+        """
+        :return: the stripped contents of a small file, or None if it can't be read
+        """
+        try:
+            with open(filename, "r") as ref_file:
+                return ref_file.read().strip()
+        except (IOError, OSError):
+            return None
+
+
+    @classmethod
+    def find_git_dir(cls, repo_dir):
+        """
+        Find the git directory for a repository: repo_dir/.git, the directory named by a
+        "gitdir:" file (submodules and worktrees), or repo_dir itself for a bare repository
+        :param repo_dir: the repository
+        :return: the git directory, or None if repo_dir doesn't look like a repository
+        """
+        if repo_dir is None:
+            return None
+
+        dot_git = os.path.join(repo_dir, ".git")
+        if os.path.isdir(dot_git):
+            return dot_git
+
+        if os.path.isfile(dot_git):
+            contents = cls._read_file(dot_git)
+            if contents is not None and contents.startswith("gitdir:"):
+                git_dir = contents[len("gitdir:"):].strip()
+                return os.path.normpath(os.path.join(repo_dir, git_dir))
+            return None
+
+        if os.path.isfile(os.path.join(repo_dir, "HEAD")) and \
+           os.path.isdir(os.path.join(repo_dir, "objects")):
+            return repo_dir
+
+        return None
+
+
+    def _ref_dir(self, refname):
+        """
+        :return: the directory holding a loose ref: per-worktree refs live in the worktree's
+                 git directory, everything else in the common directory
+        """
+        if refname == "HEAD" or not refname.startswith("refs/") or \
+           refname.startswith("refs/bisect/") or refname.startswith("refs/worktree/"):
+            return self._git_dir
+        return self._common_dir
+
+
+    def _packed_refs(self):
+        """
+        :return: dictionary of ref name to object id from the packed-refs file
+        """
+        refs = {}
+        try:
+            with open(os.path.join(self._common_dir, "packed-refs"), "r") as packed:
+                for line in packed:
+                    # skip the header and the peeled values of annotated tags
+                    if line.startswith("#") or line.startswith("^"):
+                        continue
+                    fields = line.split()
+                    if len(fields) == 2:
+                        refs[fields[1]] = fields[0]
+        except (IOError, OSError):
+            pass
+        return refs
+
+
+    def read_ref(self, refname):
+        """
+        Read one ref without following it
+        :param refname: full ref name, such as HEAD or refs/heads/master
+        :return: ("symbolic", target ref name), ("object", object id), or None if it isn't found
+        """
+        if self._git_dir is None:
+            return None
+
+        contents = self._read_file(os.path.join(self._ref_dir(refname), refname))
+        if contents is None:
+            object_id = self._packed_refs().get(refname)
+            if object_id is None:
+                return None
+            contents = object_id
+
+        if contents.startswith("ref:"):
+            return "symbolic", contents[len("ref:"):].strip()
+        if OBJECT_ID.match(contents):
+            return "object", contents
+        return None
+
+
+    def resolve(self, refname):
+        """
+        Follow a ref to the object it names
+        :param refname: full ref name, such as HEAD or refs/tags/v1.0
+        :return: the object id, or None if it can't be resolved here
+        """
+        for _ in range(MAX_SYMREF_DEPTH + 1):
+            ref = self.read_ref(refname)
+            if ref is None:
+                return None
+            kind, value = ref
+            if kind == "object":
+                return value
+            refname = value
+        return None
+
+
+    def head_commit(self):
+        """
+        :return: the commit id of HEAD, or None if it can't be found here
+        """
+        return self.resolve("HEAD")
+
+
+    def current_branch(self):
+        """
+        :return: the short name of the checked out branch, or None if HEAD is detached or
+                 can't be read here
+        """
+        head = self.read_ref("HEAD")
+        if head is None or head[0] != "symbolic" or not head[1].startswith("refs/heads/"):
+            return None
+        return head[1][len("refs/heads/"):]
@@ -14,6 +14,7 @@ import datetime
 import config
 
 from gitbits import GitBit
+from RepositoryOperator import CLONE_MODES
 
 
 class Manifest(object):
@@ -145,6 +146,16 @@ class Manifest(object):
                 valid = False
                 message.append("Either branch or commit-id should be set for entry")
 
+            # clone-mode is optional, but must be one that RepoCloner knows
+            if 'clone-mode' in repo and repo['clone-mode'] not in CLONE_MODES:
+                valid = False
+                message.append("clone-mode should be one of {0}".format(", ".join(CLONE_MODES)))
+
+            # sparse-paths is optional, but must list directories within the repository
+            if 'sparse-paths' in repo and not Manifest.valid_sparse_paths(repo['sparse-paths']):
+                valid = False
+                message.append("sparse-paths should be a list of directories within the repository")
+
             if not valid:
                 result = False
                 message.append("entry content:")
@@ -152,6 +163,23 @@ class Manifest(object):
         
         return result, message
 
+    @staticmethod
+    def valid_sparse_paths(paths):
+        """
+        Check the 'sparse-paths' of a repository entry: a non-empty list of directories,
+        relative to the top of the repository, for a cone mode sparse checkout
+        :param paths: the value of 'sparse-paths'
+        :return: True if the paths are usable
+        """
+        if not isinstance(paths, list) or not paths:
+            return False
+        for path in paths:
+            if not isinstance(path, basestring) or path.strip("/") == "" or \
+               path.startswith("/") or ".." in path.split("/"):
+                return False
+        return True
+
+
     @staticmethod
     def validate_downstream_jobs(downstream_jobs):
         """
@@ -0,0 +1,168 @@
+# Copyright 2016, EMC, Inc.
+
+"""
+Module to keep bare mirrors of remote repositories on the build host, so that checkouts
+only fetch from the remote what the mirror doesn't already have.
+
+"""
+
+import fcntl
+import hashlib
+import os
+import shutil
+import time
+
+from remote_refs import strip_credentials
+
+
+class FileLock(object):
+    """
+    An flock() on a lock file, used as a context manager.   As each FileLock opens the file
+    itself, it excludes other threads of this process as well as other processes.
+
+    Refreshing a mirror takes its lock exclusively; cloning from a mirror takes it shared,
+    so that any number of checkouts, by this run or by others on the same host, can read a
+    mirror at once but never while it is being fetched into.
+    """
+    def __init__(self, filename, exclusive):
+        """
+        :param filename: the lock file, created if needed
+        :param exclusive: True for an exclusive lock, False for a shared one
+        """
+        self._filename = filename
+        self._exclusive = exclusive
+        self._file = None
+
+
+    def acquire(self):
+        """
+        Wait for the lock
+        :return: None
+        """
+        self._file = open(self._filename, "a")
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX if self._exclusive else fcntl.LOCK_SH)
+
+
+    def release(self):
+        """
+        Give up the lock, if it is held
+        :return: None
+        """
+        if self._file is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class MirrorCache(object):
+    """
+    A directory of bare mirrors, one per remote repository URL.
+
+    Each mirror is refreshed at most once per run: a mirror fetched since the run started
+    (by this run or by another on the same host) is used as it is.   Checkouts clone from
+    the remote with --reference-if-able pointing at the mirror and --dissociate, so they get
+    their objects from the mirror but don't depend on it once the clone is done, and keep
+    the remote as their origin.
+    """
+
+    # file in each mirror recording when it was last fetched
+    stamp_file = "reprove-refreshed"
+
+    def __init__(self, directory):
+        """
+        :param directory: where the mirrors are kept; created if needed
+        """
+        self.directory = os.path.abspath(directory)
+        self.run_started = time.time()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+
+    def mirror_path(self, url):
+        """
+        :param url: the remote repository URL
+        :return: the directory of the mirror for url: the repository name, for anyone looking
+                 in the cache, and a hash of the URL, so different remotes never share a mirror
+        """
+        key = strip_credentials(url)
+        name = os.path.basename(key)
+        if name.endswith(".git"):
+            name = name[:-len(".git")]
+        return os.path.join(self.directory,
+                            "{0}-{1}.git".format(name, hashlib.sha1(key).hexdigest()[:12]))
+
+
+    def lock(self, url, exclusive):
+        """
+        :param url: the remote repository URL
+        :param exclusive: True to refresh the mirror, False to clone from it
+        :return: a FileLock for the mirror of url
+        """
+        return FileLock(self.mirror_path(url) + ".lock", exclusive)
+
+
+    def exists(self, url):
+        """
+        :return: True if there is a mirror for url
+        """
+        return os.path.isfile(os.path.join(self.mirror_path(url), "HEAD"))
+
+
+    def is_fresh(self, url):
+        """
+        :return: True if the mirror for url has been fetched since this run started
+        """
+        try:
+            stamp = os.path.getmtime(os.path.join(self.mirror_path(url), self.stamp_file))
+        except OSError:
+            return False
+        return stamp >= self.run_started
+
+
+    def refresh_command(self, url):
+        """
+        :param url: the remote repository URL
+        :return: (args, directory) of the git command which brings the mirror up to date:
+                 a fetch into an existing mirror, otherwise a clone --mirror to create it
+        """
+        path = self.mirror_path(url)
+        if self.exists(url):
+            return ['fetch', '--prune', '--quiet', 'origin'], path
+        return ['clone', '--mirror', '--quiet', url, path], self.directory
+
+
+    def refreshed(self, url):
+        """
+        Note that the mirror for url has just been fetched.   Called with the exclusive lock held.
+        :return: None
+        """
+        with open(os.path.join(self.mirror_path(url), self.stamp_file), "w") as stamp:
+            stamp.write("{0}\n".format(time.time()))
+
+
+    def discard(self, url):
+        """
+        Remove a mirror which failed to be created.   Called with the exclusive lock held.
+        :return: None
+        """
+        if not self.exists(url):
+            shutil.rmtree(self.mirror_path(url), ignore_errors=True)
+
+
+    def clone_options(self, url):
+        """
+        :return: the git clone options which take objects from the mirror of url, or an empty
+                 list if there is no mirror
+        """
+        if not self.exists(url):
+            return []
+        return ['--reference-if-able', self.mirror_path(url), '--dissociate']
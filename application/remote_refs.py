@@ -0,0 +1,193 @@
+# Copyright 2016, EMC, Inc.
+
+"""
+Module to remember the branches and tags advertised by remote repositories, so that
+existence checks for many branches and tags cost one 'git ls-remote' per remote.
+
+"""
+
+import fnmatch
+import json
+import os
+import threading
+import time
+from urlparse import urlparse, urlunparse
+
+from task_history import write_json_atomically
+
+
+def strip_credentials(url):
+    """
+    :param url: a repository URL
+    :return: the URL without any username or password (and without a trailing '/'), so
+             that it can be used as a key which is safe to write to disk
+    """
+    parsed = urlparse(url)
+    if parsed.netloc and "@" in parsed.netloc:
+        parsed = parsed._replace(netloc=parsed.netloc.rsplit("@", 1)[1])
+    return urlunparse(parsed).rstrip("/")
+
+
+class RemoteRefsCache(object):
+    """
+    The branch and tag refs of remote repositories, keyed by URL.
+
+    Each remote's refs are fetched with 'git ls-remote --heads --tags' the first time they are
+    needed, and fetched again once they are older than the TTL.   If a filename is given the
+    refs are also kept on disk, so later runs within the TTL don't ask the remote again.
+    Threads asking for the same remote at once share one fetch.
+    """
+
+    def __init__(self, ttl=300, filename=None):
+        """
+        :param ttl: seconds for which fetched refs are trusted; None to trust them for the run
+        :param filename: JSON file to keep the refs in between runs; None to keep them in memory
+        """
+        self._ttl = ttl
+        self._filename = None
+        self._lock = threading.Lock()
+        # one lock per remote, held while its refs are fetched
+        self._fetch_locks = {}
+        self._remotes = {}
+        self.set_filename(filename)
+
+
+    def set_filename(self, filename):
+        """
+        Keep the refs in filename from now on, and load any which are there already
+        :param filename: the JSON file; None to keep the refs in memory only
+        :return: None
+        """
+        with self._lock:
+            if filename == self._filename:
+                return
+            self._filename = filename
+            if filename is None or not os.path.isfile(filename):
+                return
+            try:
+                with open(filename, "r") as cache_file:
+                    remotes = json.load(cache_file)
+            except (IOError, ValueError) as error:
+                print "Ignoring unreadable remote refs cache {0}: {1}".format(filename, error)
+                return
+            if isinstance(remotes, dict):
+                self._remotes.update(remotes)
+
+
+    def set_ttl(self, ttl):
+        """
+        :param ttl: seconds for which fetched refs are trusted; None to trust them for the run
+        :return: None
+        """
+        self._ttl = ttl
+
+
+    def _save(self):
+        """
+        Write the cache file, replacing it atomically.   Called with the lock held.
+        """
+        if self._filename is None:
+            return
+
+        try:
+            write_json_atomically(self._filename, self._remotes)
+        except (IOError, OSError) as error:
+            print "Unable to save remote refs cache {0}: {1}".format(self._filename, error)
+
+
+    def get_refs(self, git, url):
+        """
+        Return the branch and tag refs of a remote, fetching them if they aren't cached
+
+        :param git: the GitBit to run ls-remote with (for its credentials)
+        :param url: the remote repository URL
+        :return: dictionary of full ref name to object id
+        """
+        key = strip_credentials(url)
+        refs = self._cached_refs(key)
+        if refs is not None:
+            return refs
+
+        with self._lock:
+            fetch_lock = self._fetch_locks.setdefault(key, threading.Lock())
+
+        with fetch_lock:
+            # another thread may have fetched them while this one waited
+            refs = self._cached_refs(key)
+            if refs is not None:
+                return refs
+
+            code, out, err = git.run(['ls-remote', '--heads', '--tags', url])
+            if code != 0:
+                raise RuntimeError("Unable to list the refs of {0}: {1}".format(url, err))
+
+            refs = {}
+            for line in (out or "").splitlines():
+                fields = line.split()
+                if len(fields) == 2:
+                    refs[fields[1]] = fields[0]
+
+            with self._lock:
+                self._remotes[key] = {'fetched': time.time(), 'refs': refs}
+                self._save()
+        return refs
+
+
+    def _cached_refs(self, key):
+        """
+        :param key: the remote's URL, without credentials
+        :return: the remote's refs, or None if they aren't cached or are older than the TTL
+        """
+        with self._lock:
+            remote = self._remotes.get(key)
+            if remote is not None and \
+               (self._ttl is None or time.time() - remote['fetched'] < self._ttl):
+                return remote['refs']
+        return None
+
+
+    def matching(self, git, url, pattern):
+        """
+        Find the refs matching an ls-remote style pattern, which matches the whole ref name
+        or its end at a '/' boundary ("heads/master" and "refs/heads/master" both match
+        refs/heads/master)
+
+        :param git: the GitBit to run ls-remote with
+        :param url: the remote repository URL
+        :param pattern: the pattern; may contain glob characters
+        :return: sorted list of the matching full ref names
+        """
+        return sorted(name for name in self.get_refs(git, url)
+                      if fnmatch.fnmatchcase(name, pattern) or
+                      fnmatch.fnmatchcase(name, "*/" + pattern))
+
+
+    def has_branch(self, git, url, branch):
+        """
+        :return: True if the remote has refs/heads/<branch>
+        """
+        return "refs/heads/" + branch in self.get_refs(git, url)
+
+
+    def has_tag(self, git, url, tag):
+        """
+        :return: True if the remote has refs/tags/<tag>
+        """
+        return "refs/tags/" + tag in self.get_refs(git, url)
+
+
+    def record(self, url, refname, object_id):
+        """
+        Note a ref which this program has just pushed, so the cache stays correct without
+        fetching the remote's refs again.   Does nothing if the remote isn't cached.
+
+        :param url: the remote repository URL
+        :param refname: the full ref name
+        :param object_id: the object the ref now names
+        :return: None
+        """
+        with self._lock:
+            remote = self._remotes.get(strip_credentials(url))
+            if remote is not None:
+                remote['refs'][refname] = object_id
+                self._save()
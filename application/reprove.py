@@ -15,7 +15,14 @@ import sys
 import config
 
 from urlparse import urlparse, urlunsplit
-from RepositoryOperator import RepoOperator
+from RepositoryOperator import RepoOperator, RepoCloner, CLONE_MODES
+from gitbits import GitBit
+from task_history import TaskHistory
+from checkout_journal import CheckoutJournal
+from git_refs import RefReader
+from mirror_cache import MirrorCache
+from task_trace import TaskTrace
+from ParallelTasks import BACKENDS, JOBS_AUTO
 from manifest import Manifest
 
 
@@ -39,9 +46,68 @@ def strip_prefix(text, prefix):
         return text
 
 
+def job_count(value):
+    """
+    argparse type for --jobs: an integer, or 'auto'
+    """
+    if value == JOBS_AUTO:
+        return value
+    return int(value)
+
+
+def host_jobs(value):
+    """
+    argparse type for --host-jobs: HOST=N
+    """
+    host, separator, count = value.rpartition("=")
+    if not separator or not host:
+        raise argparse.ArgumentTypeError("expected HOST=N, got '{0}'".format(value))
+    try:
+        return host.lower(), int(count)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected an integer job count in '{0}'".format(value))
+
+
+class ManifestTasks(RepoCloner):
+    """
+    Run the per-repository steps of the requested actions.   Checkouts and syncs are
+    performed as by RepoCloner; every other step is handed back to ManifestActions.run_repo_step.
+    """
+    def __init__(self, manifest_actions, job_count, **kwargs):
+        self._manifest_actions = manifest_actions
+        super(ManifestTasks, self).__init__(job_count, **kwargs)
+
+
+    def should_retry(self, name, data, exception):
+        """
+        Only checkouts and syncs are retried; the other steps push changes and are not safe
+        to repeat
+        """
+        if data['step'] not in ManifestActions.checkout_actions:
+            return False
+        return super(ManifestTasks, self).should_retry(name, data, exception)
+
+
+    def do_one_task(self, name, data, results):
+        """
+        :param name: the task name
+        :param data: 'step' names the step to run for 'repo'; checkout data is as for RepoCloner
+        :param results: a dictionary for storing results
+        :return: None (all output data stored in results)
+        """
+        if data['step'] in ManifestActions.checkout_actions:
+            super(ManifestTasks, self).do_one_task(name, data, results)
+        else:
+            self._manifest_actions.run_repo_step(data['step'], data['repo'])
+            results['status'] = 'success'
+
+
 class ManifestActions(object):
 
-    valid_actions = ['checkout', 'tag', 'packagerefs', 'branch']
+    valid_actions = ['checkout', 'sync', 'tag', 'packagerefs', 'branch']
+
+    # the actions which put the repositories into the build directory
+    checkout_actions = ['checkout', 'sync']
 
     def __init__(self):
         """
@@ -52,11 +118,23 @@ class ManifestActions(object):
         :return:
         """
         self._force = False
+        self._resume = False
         self._git_credentials = None
         self._builddir = None
         self._manifest = None
         self._tagname = None
+        self._branchname = None
         self._jobs = 1
+        self._backend = None
+        self._timeout = None
+        self._retries = 0
+        self._host_jobs = dict(config.host_job_limits)
+        self._fail_fast = False
+        self._mirror_cache = config.mirror_cache_directory
+        self._clone_mode = config.clone_mode
+        self._history_file = config.task_history_file
+        self._trace_file = None
+        self._task_trace = None
         self.actions = []
         self._map = {}
        
@@ -123,6 +201,10 @@ class ManifestActions(object):
         parser.add_argument("--force",
                             help="use destination dir, even if it exists",
                             action="store_true")
+        parser.add_argument("--resume",
+                            help="carry on an interrupted checkout in an existing destination dir, "
+                                 "keeping the repositories it completed",
+                            action="store_true")
         parser.add_argument("--git-credential",
                             help="Git credentials for CI services",
                             action="append")
@@ -134,8 +216,51 @@ class ManifestActions(object):
                             action="store")
         parser.add_argument("--jobs",
                             default=1,
-                            help="Number of parallel jobs to run",
+                            help="Number of parallel jobs to run, or 'auto' to adjust it "
+                                 "to the observed throughput, load and failures",
+                            type=job_count)
+        parser.add_argument("--host-jobs",
+                            help="Run at most N jobs at once against HOST (HOST=N; '*' for "
+                                 "any host not named).   May be given more than once",
+                            type=host_jobs,
+                            action="append")
+        parser.add_argument("--fail-fast",
+                            help="Stop every other repository's steps as soon as one fails, "
+                                 "rather than running them all to completion",
+                            action="store_true")
+        parser.add_argument("--backend",
+                            choices=BACKENDS,
+                            help="How parallel jobs are run (default: threads)",
+                            action="store")
+        parser.add_argument("--timeout",
+                            help="Seconds allowed for each attempt at checking out a repository",
+                            type=float)
+        parser.add_argument("--retries",
+                            default=0,
+                            help="Number of times to retry a failed checkout",
                             type=int)
+        parser.add_argument("--history-file",
+                            default=config.task_history_file,
+                            help="Where checkout times are remembered, to start the slowest first",
+                            action="store")
+        parser.add_argument("--no-history",
+                            help="Neither use nor update the checkout time history",
+                            action="store_true")
+        parser.add_argument("--trace-file",
+                            help="Write a Chrome trace event timeline of the run to this file",
+                            action="store")
+        parser.add_argument("--ssh-multiplex",
+                            help="Share one SSH connection per host between git commands",
+                            action="store_true")
+        parser.add_argument("--mirror-cache",
+                            help="Keep bare mirrors of the repositories in this directory, "
+                                 "and check out from them",
+                            action="store")
+        parser.add_argument("--clone-mode",
+                            choices=CLONE_MODES,
+                            help="How much of each repository to fetch, for repositories without "
+                                 "a clone-mode in the manifest (default: full)",
+                            action="store")
         parser.add_argument("--map",
                             nargs=2,
                             help="Remap repository URLs",
@@ -150,12 +275,21 @@ class ManifestActions(object):
         if args.force:
             self._force = True
 
+        if args.resume:
+            self._resume = True
+
         for action in args.action:
             self.add_action(action)
 
+        if 'checkout' in args.action and 'sync' in args.action:
+            print "Only one of the checkout and sync actions may be given"
+            sys.exit(1)
+
         self._builddir = args.builddir
         if 'checkout' in args.action and self._builddir is not None:
             self.check_builddir()
+        elif 'sync' in args.action and not os.path.isdir(self._builddir):
+            os.makedirs(self._builddir)
 
         if args.git_credential:
             self._git_credentials = args.git_credential
@@ -170,10 +304,44 @@ class ManifestActions(object):
         if args.jobs:
             self._jobs = args.jobs
 
-        if self._jobs < 1:
-            print "--jobs value must be an integer >=1"
+        if self._jobs != JOBS_AUTO and self._jobs < 1:
+            print "--jobs value must be an integer >=1 or auto"
             sys.exit(1)
 
+        if args.backend:
+            self._backend = args.backend
+
+        if args.timeout:
+            self._timeout = args.timeout
+
+        if args.retries:
+            self._retries = args.retries
+
+        if args.host_jobs:
+            self._host_jobs.update(args.host_jobs)
+
+        if args.fail_fast:
+            self._fail_fast = True
+
+        if args.ssh_multiplex:
+            GitBit.ssh_multiplexer.enable(config.ssh_control_persist)
+
+        if args.mirror_cache:
+            self._mirror_cache = args.mirror_cache
+
+        if args.clone_mode:
+            self._clone_mode = args.clone_mode
+
+        if args.trace_file:
+            self._trace_file = args.trace_file
+            self._task_trace = TaskTrace()
+            self.repo_operator.set_task_trace(self._task_trace)
+
+        if args.no_history:
+            self._history_file = None
+        else:
+            self._history_file = args.history_file
+
         if args.map:
             for mapping in args.map:
                 self.add_mapping(mapping)
@@ -202,6 +370,9 @@ class ManifestActions(object):
         :return: url,dir
         """
         repo_url = repo['repository']
+        if 'directory-name' in repo:
+            # one URL may be checked out more than once, each in its own directory
+            return repo_url, repo['directory-name']
         basename = strip_suffix(os.path.basename(repo_url), ".git")
         work_dir = "{0}/{1}".format(self._builddir, basename)
         return repo_url,work_dir
@@ -210,11 +381,14 @@ class ManifestActions(object):
     def check_builddir(self):
         """
         Checks the given builddir name and force flag. Deletes exists directory if one already
-        exists and --force is set
+        exists and --force is set, or keeps it to carry on from if --resume is set
         :return: None
         """
         if os.path.exists(self._builddir):
-            if self._force:
+            if self._resume:
+                print "Resuming the checkout in {0}".format(self._builddir)
+                return
+            elif self._force:
                 shutil.rmtree(self._builddir)
                 print "Removing existing data at {0}".format(self._builddir)
             else:
@@ -257,105 +431,222 @@ class ManifestActions(object):
         return error_found
 
         
-    def get_repositories(self):
-        """
-        Issues checkout commands to dictionaries within a provided manifest
-        :return: None
+    def get_repo_steps(self):
+        """
+        List the per-repository steps needed by the requested actions, in the order
+        they must be performed on each repository
+        :return: list of step names
+        """
+        steps = []
+        if 'checkout' in self.actions:
+            steps.append('checkout')
+        if 'sync' in self.actions:
+            steps.append('sync')
+        if 'tag' in self.actions:
+            steps.append('tag')
+        if 'branch' in self.actions:
+            steps.extend(['branch', 'checkout-branch', 'branch-packagerefs', 'push'])
+        if 'packagerefs' in self.actions:
+            steps.append('packagerefs')
+        return steps
+
+
+    def run_repo_step(self, step, repo):
+        """
+        Perform a single step, other than checkout, on one repository
+        :param step: a step name from get_repo_steps
+        :param repo: A dictionary
+        :return: None; raises RuntimeError on failure
         """
-        repo_list = self._manifest.get_repositories()
-        try:
-            self.repo_operator.clone_repo_list(repo_list, self._builddir, jobs=self._jobs)
-        except RuntimeError as error:
-            print "Exiting due to error: {0}".format(error)
-            sys.exit(1)
-            
+        repo_url, work_dir = self.__get_repo_url_and_dir(repo)
+
+        if step == 'tag':
+            self.repo_operator.set_repo_tagname(repo_url, work_dir, self._tagname)
+        elif step == 'branch':
+            # published by the push step, once the branch has been made in every repository
+            self.repo_operator.create_repo_branch(repo_url, work_dir, self._branchname,
+                                                  publish=False)
+        elif step == 'checkout-branch':
+            self.repo_operator.checkout_repo_branch(repo_url, work_dir, self._branchname)
+        elif step == 'branch-packagerefs':
+            self.update_repo_package_list(repo, pkg_version=self._branchname)
+        elif step == 'push':
+            commit_message = "update the dependencies version to {0}".format(self._branchname)
+            self.repo_operator.push_repo_changes(repo_url, work_dir, commit_message,
+                                                 branch_name=self._branchname)
+        elif step == 'packagerefs':
+            self.update_repo_package_list(repo)
+        else:
+            raise ValueError("Unknown step '{0}'".format(step))
+
 
-    def create_repo_branch(self, repo, branch):
+    def run_repository_tasks(self):
         """
-        create branch  on the repos in the manifest file
-        :param repo: A dictionary
+        Run every step of the requested actions on every repository in the manifest.
+        Each repository moves on to its next step as soon as its previous step is done,
+        without waiting for the other repositories; the one exception is push, which publishes
+        the new branch and waits until it has been created in every repository, so that
+        nothing is pushed when the branch can't be made everywhere.
         :return: None
         """
+        repo_list = self._manifest.get_repositories()
+        if not repo_list:
+            print "No repository list found in manifest file"
+            sys.exit(2)
 
-        repo_url,work_dir = self.__get_repo_url_and_dir(repo)
-
-        try:
-            self.repo_operator.create_repo_branch(repo_url, work_dir, branch)
-        except RuntimeError as error:
-            print "Exiting due to error: {0}".format(error)
+        # start the checkouts expected to take longest first
+        history = None
+        checkouts = {}
+        if self._history_file is not None and 'checkout' in self.actions:
+            history = TaskHistory(self._history_file)
+            repo_list = history.longest_first(repo_list, lambda repo: repo['repository'])
+
+        if 'sync' in self.actions:
+            self.report_stray_directories(repo_list)
+
+        # completed checkouts are journaled, so that an interrupted run can be resumed
+        journal = None
+        mirror_cache = None
+        if 'checkout' in self.actions or 'sync' in self.actions:
+            journal = CheckoutJournal(self._builddir)
+            if self._mirror_cache is not None:
+                mirror_cache = MirrorCache(self._mirror_cache)
+
+        # each URL is cloned once; its other checkouts are added to that clone as worktrees
+        worktrees = RepoCloner.find_worktrees(repo_list)
+        checkout_tasks = {}
+        branch_tasks = ["branch {0}".format(repo['directory-name']) for repo in repo_list]
+
+        with ManifestTasks(self, self._jobs, backend=self._backend, task_timeout=self._timeout,
+                           retries=self._retries, group_limits=self._host_jobs,
+                           fail_fast=self._fail_fast) as tasks:
+            for repo in repo_list:
+                previous = None
+                directory_name = RepoCloner.get_destination_directory_name(repo)
+                for step in self.get_repo_steps():
+                    data = {'step': step,
+                            'repo': repo,
+                            'builddir': self._builddir,
+                            'credentials': self._git_credentials,
+                            'mirror_cache': mirror_cache,
+                            'clone_mode': self._clone_mode,
+                            'sync': step == 'sync',
+                            'worktree_of': worktrees.get(directory_name)
+                           }
+                    name = "{0} {1}".format(step, repo['directory-name'])
+                    depends_on = [previous] if previous else []
+                    if step == 'push':
+                        depends_on.extend(branch_tasks)
+                    if step in self.checkout_actions:
+                        if step == 'checkout' and self._resume and \
+                           not self.prepare_resume(journal, repo):
+                            continue
+                        checkouts[name] = repo
+                        checkout_tasks[directory_name] = name
+                        # a worktree waits for its clone, unless that was kept from before
+                        clone_task = checkout_tasks.get(worktrees.get(directory_name))
+                        if clone_task is not None:
+                            depends_on.append(clone_task)
+                    tasks.add_task(data, name, depends_on or None)
+                    previous = name
+
+            error = False
+            for name, result in tasks.as_completed():
+                if self._task_trace is not None:
+                    self._task_trace.add_task(name, result)
+                if 'commands' in result:
+                    error |= self.print_command_summary(name, {name: result})
+                status = result.get('status')
+                if status != 'success':
+                    error = True
+                    if 'exception' in result:
+                        print "{0}: {1}".format(name, result['exception'])
+                    else:
+                        print "{0}: {1}".format(name, status)
+                elif name in checkouts:
+                    self.journal_checkout(journal, checkouts[name])
+                    worktree = RepoCloner.get_destination_directory_name(checkouts[name]) in worktrees
+                    if history is not None and not worktree:
+                        history.record(checkouts[name]['repository'], tasks.last_attempt_seconds(result))
+
+        if history is not None:
+            history.save()
+
+        self.repo_operator.close()
+        self.write_trace()
+        GitBit.command_stats.print_summary()
+
+        if error:
+            print "Exiting due to error in the steps above"
             sys.exit(1)
 
-    def checkout_repo_branch(self, repo, branch):
+
+    def report_stray_directories(self, repo_list):
         """
-        checkout to a specify branch on repository
-        :param repo: A dictionary
-        :param branch: the specify branch name
+        Print the entries of the build directory which no repository in the manifest is
+        checked out into.   They are only reported, never removed.
+        :param repo_list: the manifest repositories
         :return: None
         """
-        repo_url,work_dir = self.__get_repo_url_and_dir(repo)
+        expected = [os.path.realpath(repo['directory-name']) for repo in repo_list]
+        ignored = [RepoCloner.output_log_directory, CheckoutJournal.filename]
+        for entry in sorted(os.listdir(self._builddir)):
+            path = os.path.realpath(os.path.join(self._builddir, entry))
+            if entry in ignored or \
+               any(directory == path or directory.startswith(path + os.sep)
+                   for directory in expected):
+                continue
+            print "Not in the manifest: {0}".format(os.path.join(self._builddir, entry))
 
-        try:
-            self.repo_operator.checkout_repo_branch(repo_url, work_dir, branch)
-        except RuntimeError as error:
-            print "Exiting due to error: {0}".format(error)
-            sys.exit(1)
 
-    def branch_existing_repositories(self):
+    def prepare_resume(self, journal, repo):
         """
-        Issues create branch commands to repos in a provided manifest
-        :return: None
+        Decide whether a repository still needs to be checked out when resuming.   A
+        checkout which the journal shows as complete, and which is still at the commit
+        recorded then, is kept; anything else left in its directory is removed.
+
+        :param journal: the CheckoutJournal for the build directory
+        :param repo: the manifest repository entry
+        :return: True if the repository needs to be checked out
         """
-        if self._branchname is None:
-            print "Please provide the new branch name"
-            sys.exit(2)
+        directory = repo['directory-name']
+        commit = journal.is_complete(repo, directory)
+        if commit is not None:
+            print "Keeping checkout of {0}, already at {1}".format(repo['repository'], commit)
+            return False
 
-        repo_list = self._manifest.get_repositories()
-        if repo_list is None:
-            print "No repository list found in manifest file"
-            sys.exit(2)
-        else:
-            # Loop through list of repos and create specified branch on each
-            for repo in repo_list:
-                self.create_repo_branch(repo, self._branchname)
+        if os.path.realpath(directory) == os.path.realpath(self._builddir):
+            raise ValueError("{0} would be checked out over the whole build directory".format(
+                repo['repository']))
+
+        if os.path.exists(directory):
+            print "Removing incomplete checkout {0}".format(directory)
+            shutil.rmtree(directory)
+        return True
 
-    def checkout_branch_repositories(self, branch):
-        repo_list = self._manifest.get_repositories()
-        if repo_list is None:
-            print "No repository list found in manifest file"
-            sys.exit(2)
-        else:
-            # Loop through list of repos and checkout specified branch on each
-            for repo in repo_list:
-                self.checkout_repo_branch(repo, branch)
 
-    def set_repo_tagname(self, repo):
+    def journal_checkout(self, journal, repo):
         """
-        Sets tagname on the repos in the manifest file
-        :param repo: A dictionary
+        Record a completed checkout, with the commit now at its HEAD, in the journal
+        :param journal: the CheckoutJournal for the build directory
+        :param repo: the manifest repository entry
         :return: None
         """
-        repo_url,work_dir = self.__get_repo_url_and_dir(repo)
-
-        try:
-            self.repo_operator.set_repo_tagname(repo_url, work_dir, self._tagname)
-        except RuntimeError as error:
-            print "Exiting due to error: {0}".format(error)
-            sys.exit(1)
+        directory = repo['directory-name']
+        commit = RefReader(directory).head_commit()
+        if commit is None:
+            commit = self.repo_operator.get_lastest_commit_id(directory)
+        journal.record(repo, directory, commit)
 
 
-    def tag_existing_repositories(self):
+    def write_trace(self):
         """
-        Issues set_tagname commands to repos in a provided manifest
+        Write the timeline of the run, if --trace-file was given
         :return: None
         """
-        repo_list = self._manifest.get_repositories()
-        if repo_list is None:
-            print "No repository list found in manifest file"
-            sys.exit(2)
-        else:
-            # Loop through list of repos and create specified tag on each
-            for repo in repo_list:
-                self.set_repo_tagname(repo)
+        if self._task_trace is not None:
+            self._task_trace.write(self._trace_file)
+            print "Wrote task timeline to {0}".format(self._trace_file)
 
 
     def directory_for_repo(self, repo):
@@ -464,75 +755,24 @@ class ManifestActions(object):
             print "There are NO changes to data for {0}".format(package_json_file)
 
 
-    def update_package_references(self, version=None):
-        print "Update internal package lists"
-
-        repo_list = self._manifest.get_repositories()
-        if repo_list is None:
-            print "No repository list found in manifest file"
-            sys.exit(2)
-        else:
-            # Loop through list of repos and update package.json on each
-            for repo in repo_list:
-                self.update_repo_package_list(repo, pkg_version=version)
-
-
-    def push_changed_repo(self, repo, commit_message):
-        """
-        publish changes in the repository
-        :param repo: A dictionary
-        :param commit_message: the message to be added to the commit
-        :return: None
-        """
-        repo_url,work_dir = self.__get_repo_url_and_dir(repo)
-
-        try:
-            self.repo_operator.push_repo_changes(repo_url, work_dir, commit_message)
-        except RuntimeError as error:
-            print "Exiting due to error: {0}".format(error)
-            sys.exit(1)
-
-    def push_changed_repositories(self, commit_message):
-        repo_list = self._manifest.get_repositories()
-        if repo_list is None:
-            print "No repository list found in manifest file"
-            sys.exit(2)
-        else:
-            # Loop through list of repos and publish changes on each
-            for repo in repo_list:
-                self.push_changed_repo(repo, commit_message)
-   
-
 def main():
     manifest_actions = ManifestActions()
 
-    if 'checkout' in manifest_actions.actions:
-        manifest_actions.get_repositories()
-
     if 'tag' in manifest_actions.actions:
         if manifest_actions.get_tagname() is not None:
             print "Setting tags for the repos..."
-            manifest_actions.tag_existing_repositories()
         else:
             print "No setting for --tagname"
             sys.exit(1)
 
-
     if 'branch' in manifest_actions.actions:
-        new_branch = manifest_actions.get_branchname()
-        if new_branch is not None:
+        if manifest_actions.get_branchname() is not None:
             print "create branch and update package.json for the repos..."
-            manifest_actions.branch_existing_repositories()
-            manifest_actions.checkout_branch_repositories(new_branch)
-            manifest_actions.update_package_references(version=new_branch)            
-            commit_message = "update the dependencies version to {0}".format(new_branch)
-            manifest_actions.push_changed_repositories(commit_message)
         else:
             print "No setting for --branchname"
             sys.exit(1)
 
-    if 'packagerefs' in manifest_actions.actions:
-        manifest_actions.update_package_references()
+    manifest_actions.run_repository_tasks()
 
 
 if __name__ == "__main__":
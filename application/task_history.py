@@ -0,0 +1,119 @@
+# Copyright 2016, EMC, Inc.
+
+"""
+Module to remember how long tasks took on previous runs, so that future runs can schedule
+the longest tasks first.
+
+"""
+
+import json
+import os
+import tempfile
+
+
+def write_json_atomically(filename, data):
+    """
+    Write data to a JSON file, replacing it in one step so that a concurrent reader never
+    sees a partly written file.   The file's directory is created if needed.
+    :param filename: the JSON file
+    :param data: the data to write
+    :return: None; raises IOError or OSError on failure
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    (fd, temporary) = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, "w") as json_file:
+        json.dump(data, json_file, indent=4, sort_keys=True)
+    os.rename(temporary, filename)
+
+
+class TaskHistory(object):
+    """
+    A small on-disk record of task durations, keyed by an arbitrary string (for checkouts,
+    the repository URL).   Each new duration is blended with the ones seen before, so one
+    unusually fast or slow run does not throw the estimate off.
+    """
+
+    # weight given to the newest duration when blending it into the estimate
+    smoothing = 0.5
+
+    def __init__(self, filename):
+        """
+        :param filename: the JSON file holding the history; need not exist yet
+        """
+        self._filename = filename
+        self._durations = {}
+        self.load()
+
+
+    def load(self):
+        """
+        Read the history file.  A missing or unreadable file just means no history.
+        :return: None
+        """
+        self._durations = {}
+        if self._filename is None or not os.path.isfile(self._filename):
+            return
+
+        try:
+            with open(self._filename, "r") as history_file:
+                durations = json.load(history_file)
+        except (IOError, ValueError) as error:
+            print "Ignoring unreadable task history {0}: {1}".format(self._filename, error)
+            return
+
+        if isinstance(durations, dict):
+            self._durations = durations
+
+
+    def save(self):
+        """
+        Write the history file.   The file is replaced atomically, so a concurrent run
+        never reads a partly written file.
+        :return: None
+        """
+        if self._filename is None:
+            return
+
+        try:
+            write_json_atomically(self._filename, self._durations)
+        except (IOError, OSError) as error:
+            print "Unable to save task history {0}: {1}".format(self._filename, error)
+
+
+    def get(self, key, default=None):
+        """
+        :param key: the task key
+        :param default: returned if the task has never been recorded
+        :return: the expected duration of the task, in seconds
+        """
+        return self._durations.get(key, default)
+
+
+    def record(self, key, seconds):
+        """
+        Blend a newly measured duration into the estimate for a task
+        :param key: the task key
+        :param seconds: how long the task took
+        :return: None
+        """
+        previous = self._durations.get(key)
+        if previous is None:
+            self._durations[key] = seconds
+        else:
+            self._durations[key] = previous + self.smoothing * (seconds - previous)
+
+
+    def longest_first(self, items, key):
+        """
+        Order items by expected duration, longest first.   Items never seen before are
+        treated as the longest, since nothing is known about them; otherwise the original
+        order is kept.
+
+        :param items: the items to order
+        :param key: a function returning the history key of an item
+        :return: a new, sorted list
+        """
+        unknown = float('inf')
+        return sorted(items, key=lambda item: -self.get(key(item), unknown))
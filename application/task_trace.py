@@ -0,0 +1,99 @@
+# Copyright 2016, EMC, Inc.
+
+"""
+Module to turn ParallelTasks results into a timeline, written in the Chrome trace event
+format (load it with chrome://tracing or https://ui.perfetto.dev).
+
+"""
+
+import datetime
+import json
+import os
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def _microseconds(when):
+    """
+    :param when: a datetime
+    :return: microseconds since the epoch, as used for trace event timestamps
+    """
+    return int((when - _EPOCH).total_seconds() * 1000000)
+
+
+class TaskTrace(object):
+    """
+    Collect a span for every finished task, and for every git command it ran, laid out
+    with one lane per worker (process id, thread).
+    """
+    def __init__(self):
+        self._events = []
+        self._lanes = {}
+
+
+    def _lane(self, task):
+        """
+        Return the (pid, tid) lane for a task, naming the lane the first time it is seen
+        """
+        pid = task.get('pid', os.getpid())
+        thread = task.get('thread', 0)
+        if (pid, thread) not in self._lanes:
+            tid = len([lane for lane in self._lanes if lane[0] == pid]) + 1
+            self._lanes[(pid, thread)] = tid
+            if tid == 1:
+                self._events.append({'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+                                     'args': {'name': "pid {0}".format(pid)}})
+            self._events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+                                 'args': {'name': "worker {0}".format(tid)}})
+        return pid, self._lanes[(pid, thread)]
+
+
+    def _span(self, name, category, start_time, end_time, pid, tid, args):
+        self._events.append({'name': name,
+                             'cat': category,
+                             'ph': 'X',
+                             'ts': _microseconds(start_time),
+                             'dur': max(_microseconds(end_time) - _microseconds(start_time), 0),
+                             'pid': pid,
+                             'tid': tid,
+                             'args': args
+                            })
+
+
+    def add_task(self, name, results):
+        """
+        Add a finished task to the timeline.  Tasks which never ran (skipped, cancelled)
+        have no timing and are left out.
+
+        :param name: the task name
+        :param results: the task results, as produced by ParallelTasks
+        :return: None
+        """
+        task = results.get('task', {})
+        if 'start_time' not in task or 'end_time' not in task:
+            return
+
+        pid, tid = self._lane(task)
+        self._span(name, 'task', task['start_time'], task['end_time'], pid, tid,
+                   {'status': results.get('status'),
+                    'attempts': task.get('attempt_count', 1)
+                   })
+
+        for command in results.get('commands', []):
+            if 'start_time' not in command or 'end_time' not in command:
+                continue
+            self._span(" ".join(command['command']), 'git',
+                       command['start_time'], command['end_time'], pid, tid,
+                       {'task': name,
+                        'return_code': command.get('return_code')
+                       })
+
+
+    def write(self, filename):
+        """
+        Write the timeline as a Chrome trace event JSON file
+        :param filename: where to write the trace
+        :return: None
+        """
+        with open(filename, "w") as trace_file:
+            json.dump({'traceEvents': self._events, 'displayTimeUnit': 'ms'}, trace_file, indent=1)
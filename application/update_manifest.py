@@ -16,7 +16,9 @@ import shutil
 #pylint: disable=relative-import
 import config
 from RepositoryOperator import RepoOperator
+from gitbits import GitBit
 from manifest import Manifest
+from task_trace import TaskTrace
 
 
 class UpdateManifest(object):
@@ -44,6 +46,8 @@ class UpdateManifest(object):
         self.__cleanup_directories = []
         self.__git_credentials = None
         self.__updated_manifest = None
+        self.__trace_file = None
+        self.__task_trace = None
         self.__dryrun = False
         self.quiet = False
         self.repo_operator = RepoOperator()
@@ -80,6 +84,20 @@ class UpdateManifest(object):
         parser.add_argument('--updated_manifest',
                             help="file containing the name of the updated manifest",
                             action="store")
+        parser.add_argument('--trace-file',
+                            help="Write a Chrome trace event timeline of the clones to this file",
+                            action="store")
+        parser.add_argument('--ssh-multiplex',
+                            help="Share one SSH connection per host between git commands",
+                            action="store_true")
+        parser.add_argument('--remote-refs-cache',
+                            help="Keep the branches listed from each remote in this file, so later runs "
+                                 "within --remote-refs-ttl don't list them again",
+                            action="store")
+        parser.add_argument('--remote-refs-ttl',
+                            help="Seconds for which the branches listed from a remote are trusted",
+                            type=int,
+                            action="store")
         parser = parser.parse_args(args)
 
         return parser
@@ -127,6 +145,20 @@ class UpdateManifest(object):
         if args.updated_manifest:
             self.__updated_manifest = args.updated_manifest
 
+        if args.ssh_multiplex:
+            GitBit.ssh_multiplexer.enable(config.ssh_control_persist)
+
+        if args.remote_refs_ttl is not None:
+            self.repo_operator.remote_refs.set_ttl(args.remote_refs_ttl)
+
+        if args.remote_refs_cache:
+            self.repo_operator.remote_refs.set_filename(args.remote_refs_cache)
+
+        if args.trace_file and self.__task_trace is None:
+            self.__trace_file = args.trace_file
+            self.__task_trace = TaskTrace()
+            self.repo_operator.set_task_trace(self.__task_trace)
+
     def check_args(self):
         """
         Check the values given for branch and commit-id
@@ -199,6 +231,11 @@ class UpdateManifest(object):
             if message is not None:
                 print "\nERROR: {0}".format(message)
             print "\nCleaning environment!\n"
+        self.repo_operator.close()
+        if self.__task_trace is not None:
+            self.__task_trace.write(self.__trace_file)
+        if not self.quiet:
+            GitBit.command_stats.print_summary()
         for item in self.__cleanup_directories:
             subprocess.check_output(["rm", "-rf", item])
         sys.exit(code)
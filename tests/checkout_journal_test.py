@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from application.checkout_journal import CheckoutJournal
+
+COMMIT_A = "a" * 40
+COMMIT_B = "b" * 40
+
+
+class CheckoutJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.builddir = tempfile.mkdtemp()
+        self.directory = os.path.join(self.builddir, "repo")
+        self.repo = {'repository': "https://example.com/org/repo.git", 'branch': "master"}
+        self.set_head(COMMIT_A)
+
+    def tearDown(self):
+        shutil.rmtree(self.builddir)
+
+    def set_head(self, commit):
+        """
+        Make the checkout directory look like a repository with HEAD at commit
+        """
+        git_dir = os.path.join(self.directory, ".git")
+        if not os.path.isdir(git_dir):
+            os.makedirs(git_dir)
+        with open(os.path.join(git_dir, "HEAD"), "w") as head:
+            head.write(commit + "\n")
+
+    def test_complete_checkout_kept(self):
+        """
+        A journaled checkout still at its recorded commit is complete, also after reloading
+        """
+        journal = CheckoutJournal(self.builddir)
+        self.assertIsNone(journal.is_complete(self.repo, self.directory))
+        journal.record(self.repo, self.directory, COMMIT_A)
+        self.assertEqual(journal.is_complete(self.repo, self.directory), COMMIT_A)
+        self.assertEqual(CheckoutJournal(self.builddir).is_complete(self.repo, self.directory),
+                         COMMIT_A)
+
+    def test_changes_not_complete(self):
+        """
+        A moved HEAD, or a changed manifest entry, means the checkout must be redone
+        """
+        journal = CheckoutJournal(self.builddir)
+        journal.record(self.repo, self.directory, COMMIT_A)
+
+        changed = dict(self.repo, tag="v1.0")
+        self.assertIsNone(journal.is_complete(changed, self.directory))
+
+        self.set_head(COMMIT_B)
+        self.assertIsNone(journal.is_complete(self.repo, self.directory))
+
+    def test_truncated_entry_ignored(self):
+        """
+        A last line cut short by a crash is ignored
+        """
+        journal = CheckoutJournal(self.builddir)
+        journal.record(self.repo, self.directory, COMMIT_A)
+        with open(os.path.join(self.builddir, CheckoutJournal.filename), "a") as journal_file:
+            journal_file.write('{"commit": "')
+
+        self.assertEqual(CheckoutJournal(self.builddir).is_complete(self.repo, self.directory),
+                         COMMIT_A)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from application.git_refs import RefReader
+from application.gitbits import GitBit
+
+COMMIT_A = "a" * 40
+COMMIT_B = "b" * 40
+TAG_OBJECT = "c" * 40
+
+
+def write_file(filename, contents):
+    """
+    Write contents to filename, making its directory as needed
+    """
+    if not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    with open(filename, "w") as output:
+        output.write(contents)
+
+
+class RefReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.repo_dir = tempfile.mkdtemp()
+        self.git_dir = os.path.join(self.repo_dir, ".git")
+        write_file(os.path.join(self.git_dir, "HEAD"), "ref: refs/heads/master\n")
+        write_file(os.path.join(self.git_dir, "refs", "heads", "master"), COMMIT_A + "\n")
+        write_file(os.path.join(self.git_dir, "packed-refs"),
+                   "# pack-refs with: peeled fully-peeled sorted \n"
+                   "{0} refs/heads/release\n"
+                   "{1} refs/tags/v1.0\n"
+                   "^{0}\n".format(COMMIT_B, TAG_OBJECT))
+
+    def tearDown(self):
+        shutil.rmtree(self.repo_dir)
+
+    def test_branch_head(self):
+        """
+        HEAD on a branch gives the branch name and the commit of its loose ref
+        """
+        reader = RefReader(self.repo_dir)
+        self.assertEqual(reader.current_branch(), "master")
+        self.assertEqual(reader.head_commit(), COMMIT_A)
+
+    def test_packed_refs(self):
+        """
+        Refs only in packed-refs are found, and a loose ref overrides a packed one
+        """
+        write_file(os.path.join(self.git_dir, "HEAD"), "ref: refs/heads/release\n")
+        reader = RefReader(self.repo_dir)
+        self.assertEqual(reader.head_commit(), COMMIT_B)
+        self.assertEqual(reader.resolve("refs/tags/v1.0"), TAG_OBJECT)
+
+        write_file(os.path.join(self.git_dir, "refs", "heads", "release"), COMMIT_A + "\n")
+        self.assertEqual(reader.head_commit(), COMMIT_A)
+
+    def test_detached_head(self):
+        """
+        A detached HEAD has a commit but no branch
+        """
+        write_file(os.path.join(self.git_dir, "HEAD"), COMMIT_B + "\n")
+        reader = RefReader(self.repo_dir)
+        self.assertIsNone(reader.current_branch())
+        self.assertEqual(reader.head_commit(), COMMIT_B)
+
+    def test_unresolvable(self):
+        """
+        Unborn branches, reftable repositories and non-repositories give None
+        """
+        write_file(os.path.join(self.git_dir, "HEAD"), "ref: refs/heads/unborn\n")
+        self.assertIsNone(RefReader(self.repo_dir).head_commit())
+
+        os.mkdir(os.path.join(self.git_dir, "reftable"))
+        self.assertIsNone(RefReader(self.repo_dir).current_branch())
+
+        self.assertIsNone(RefReader(tempfile.gettempdir()).head_commit())
+
+    def test_gitdir_file(self):
+        """
+        A .git file naming the git directory (as submodules and worktrees use) is followed
+        """
+        worktree = os.path.join(self.repo_dir, "worktree")
+        worktree_git_dir = os.path.join(self.git_dir, "worktrees", "worktree")
+        write_file(os.path.join(worktree, ".git"), "gitdir: {0}\n".format(worktree_git_dir))
+        write_file(os.path.join(worktree_git_dir, "HEAD"), "ref: refs/heads/release\n")
+        write_file(os.path.join(worktree_git_dir, "commondir"), "../..\n")
+
+        reader = RefReader(worktree)
+        self.assertEqual(reader.current_branch(), "release")
+        self.assertEqual(reader.head_commit(), COMMIT_B)
+
+    def test_matches_git(self):
+        """
+        The answers for a real repository match git's own
+        """
+        shutil.rmtree(self.git_dir)
+        git = GitBit()
+        git.set_identity("tester", "tester@example.com")
+        git.run(['init', '-q'], self.repo_dir)
+        git.run(['checkout', '-q', '-b', 'feature'], self.repo_dir)
+        git.run(['commit', '-q', '--allow-empty', '-m', 'a commit'], self.repo_dir)
+        git.run(['pack-refs', '--all'], self.repo_dir)
+
+        reader = RefReader(self.repo_dir)
+        self.assertEqual(reader.current_branch(),
+                         git.run(['symbolic-ref', '--short', 'HEAD'], self.repo_dir)[1].strip())
+        self.assertEqual(reader.head_commit(),
+                         git.run(['rev-parse', 'HEAD'], self.repo_dir)[1].strip())
+
+
+if __name__ == '__main__':
+    unittest.main()
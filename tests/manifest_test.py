@@ -85,6 +85,22 @@ class ManifestTest(unittest.TestCase):
                 self.assertFalse(raised, 'Exception raised')
 
 
+    def test_validate_sparse_paths(self):
+        """
+        Manifest validate_repositories accepts sparse-paths listing directories within the
+        repository, and rejects anything else
+        """
+        repo = {"repository": "https://github.com/RackHD/on-tasks.git", "branch": "master"}
+        repo["sparse-paths"] = ["lib", "spec/lib/"]
+        result, message = Manifest.validate_repositories([repo])
+        self.assertTrue(result)
+
+        for paths in ["lib", [], [""], ["/lib"], ["lib/../.."], [3]]:
+            repo["sparse-paths"] = paths
+            result, message = Manifest.validate_repositories([repo])
+            self.assertFalse(result, paths)
+
+
     def test_update_manifest_unchanged(self):
         """
         Manifest update_manifest should not update manifest if repository is not changed
@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+
+import time
+import unittest
+
+from application.ParallelTasks import ParallelTasks, JobAutotuner, BACKENDS, JOBS_AUTO
+from application.ParallelTasks import ANY_GROUP, BACKEND_THREADS
+
+
+class EchoTasks(ParallelTasks):
+    """
+    Trivial task runner used to exercise the ParallelTasks machinery
+    """
+    def do_one_task(self, name, data, results):
+        if data == 'fail':
+            raise RuntimeError("failing on request")
+        if data == 'bad-data':
+            raise ValueError("not worth retrying")
+        if data == 'flaky' and len(results['task']['attempts']) < 2:
+            raise RuntimeError("failing on early attempts")
+        if data == 'flaky':
+            data = 0
+        if data == 'slow':
+            time.sleep(0.1)
+            data = 0
+        if data == 'until-cancelled':
+            if self.get_cancel_event().wait(10):
+                raise RuntimeError("cancelled")
+            data = 0
+        results['value'] = data * 2
+        results['status'] = 'success'
+
+
+class ParallelTasksTest(unittest.TestCase):
+
+    def test_results_returned_per_task(self):
+        """
+        ParallelTasks collects one result record per task, keyed by task name, with every backend
+        """
+        for backend in BACKENDS:
+            tasks = EchoTasks(2, backend=backend)
+            for i in range(5):
+                tasks.add_task(i, "task{0}".format(i))
+            tasks.finish()
+            results = tasks.get_results()
+
+            self.assertEqual(sorted(results.keys()), ["task{0}".format(i) for i in range(5)])
+            for i in range(5):
+                result = results["task{0}".format(i)]
+                self.assertEqual(result['value'], i * 2)
+                self.assertEqual(result['status'], 'success')
+                self.assertEqual(result['task']['name'], "task{0}".format(i))
+                self.assertTrue('elapsed_time' in result['task'])
+
+    def test_unknown_backend_fails(self):
+        """
+        ParallelTasks refuses an unknown backend name
+        """
+        with self.assertRaises(ValueError):
+            EchoTasks(1, backend='fibers')
+
+    def test_exception_recorded(self):
+        """
+        ParallelTasks records an exception raised by do_one_task in the task results
+        """
+        tasks = EchoTasks(1)
+        tasks.add_task('fail', 'bad')
+        tasks.finish()
+        result = tasks.get_results()['bad']
+
+        self.assertEqual(result['status'], 'exception')
+        self.assertTrue(isinstance(result['exception'], RuntimeError))
+
+    def test_dependencies_run_in_order(self):
+        """
+        ParallelTasks runs a task only after the tasks it depends on, and skips it if one failed
+        """
+        for backend in BACKENDS:
+            tasks = EchoTasks(2, backend=backend)
+            # added before the task it depends on
+            tasks.add_task(3, 'second', depends_on=['first'])
+            tasks.add_task(1, 'first')
+            tasks.add_task('fail', 'broken')
+            tasks.add_task(5, 'after-broken', depends_on=['first', 'broken'])
+            tasks.add_task(7, 'orphan', depends_on=['missing'])
+            tasks.finish()
+            results = tasks.get_results()
+
+            self.assertEqual(results['second']['status'], 'success')
+            self.assertTrue(results['second']['task']['start_time'] >=
+                            results['first']['task']['end_time'])
+            self.assertEqual(results['after-broken']['status'], 'skipped')
+            self.assertEqual(results['after-broken']['failed_dependencies'], ['broken'])
+            self.assertEqual(results['orphan']['status'], 'unresolved')
+            self.assertEqual(results['orphan']['waiting_on'], ['missing'])
+
+    def test_pool_reused_across_batches(self):
+        """
+        ParallelTasks workers stay up between batches, and wait() returns only the latest batch
+        """
+        for backend in BACKENDS:
+            with EchoTasks(2, backend=backend) as tasks:
+                tasks.add_task(1, 'one')
+                self.assertEqual(tasks.wait().keys(), ['one'])
+                tasks.add_task(2, 'two')
+                batch = tasks.wait()
+                self.assertEqual(batch.keys(), ['two'])
+                self.assertEqual(batch['two']['value'], 4)
+                self.assertEqual(sorted(tasks.get_results().keys()), ['one', 'two'])
+
+            with self.assertRaises(RuntimeError):
+                tasks.add_task(3, 'three')
+
+    def test_workers_exit_on_close(self):
+        """
+        ParallelTasks.close stops every worker without terminating it
+        """
+        for backend in BACKENDS:
+            tasks = EchoTasks(3, backend=backend)
+            tasks.add_task(1, 'one')
+            tasks.finish()
+            for worker in tasks._processes:
+                self.assertFalse(worker.is_alive())
+                if backend == 'processes':
+                    self.assertEqual(worker.exitcode, 0)
+
+    def test_failed_tasks_retried(self):
+        """
+        ParallelTasks retries retryable failures, recording every attempt
+        """
+        for backend in BACKENDS:
+            tasks = EchoTasks(2, backend=backend, retries=2, retry_delay=0.01)
+            tasks.add_task('flaky', 'flaky')
+            tasks.add_task('fail', 'fail')
+            tasks.add_task('bad-data', 'bad-data')
+            tasks.finish()
+            results = tasks.get_results()
+
+            self.assertEqual(results['flaky']['status'], 'success')
+            self.assertEqual(results['flaky']['task']['attempt_count'], 3)
+            self.assertEqual([attempt['status'] for attempt in results['flaky']['task']['attempts']],
+                             ['exception', 'exception', 'success'])
+            self.assertEqual(results['fail']['status'], 'exception')
+            self.assertEqual(results['fail']['task']['attempt_count'], 3)
+            self.assertEqual(results['bad-data']['task']['attempt_count'], 1)
+
+    def test_task_deadline_published(self):
+        """
+        ParallelTasks gives each attempt a deadline when a task timeout is set
+        """
+        tasks = EchoTasks(1, backend='inline', task_timeout=30)
+        tasks.add_task(1, 'one')
+        tasks.finish()
+        self.assertTrue(tasks.get_results()['one']['task']['deadline'] is not None)
+
+    def test_as_completed_yields_each_task(self):
+        """
+        ParallelTasks.as_completed yields every task of the batch once, without keeping results
+        """
+        for backend in BACKENDS:
+            with EchoTasks(2, backend=backend) as tasks:
+                for i in range(4):
+                    tasks.add_task(i, "task{0}".format(i))
+                tasks.add_task(9, 'dependent', depends_on=['task3'])
+
+                seen = {}
+                for name, result in tasks.as_completed():
+                    seen[name] = result['value']
+                    if name == 'dependent':
+                        self.assertTrue('task3' in seen)
+
+                self.assertEqual(seen, {'task0': 0, 'task1': 2, 'task2': 4, 'task3': 6,
+                                        'dependent': 18})
+                self.assertEqual(tasks.get_results(), {})
+                self.assertEqual(tasks.wait(), {})
+
+    def test_group_limits(self):
+        """
+        ParallelTasks runs no more tasks of a group at once than its limit, running tasks of
+        other groups meanwhile
+        """
+        def most_at_once(results, prefix):
+            events = []
+            for name, result in results.items():
+                if name.startswith(prefix):
+                    events.append((result['task']['start_time'], 1))
+                    events.append((result['task']['end_time'], -1))
+            running = most = 0
+            for _, change in sorted(events):
+                running += change
+                most = max(most, running)
+            return most
+
+        with EchoTasks(4, backend=BACKEND_THREADS,
+                       group_limits={'busy': 1, ANY_GROUP: 2}) as tasks:
+            for i in range(3):
+                tasks.add_task('slow', "busy{0}".format(i), group='busy')
+            for i in range(3):
+                tasks.add_task('slow', "other{0}".format(i), group='other')
+            tasks.add_task('slow', 'ungrouped')
+            results = tasks.wait()
+
+        self.assertEqual(len(results), 7)
+        self.assertEqual(most_at_once(results, 'busy'), 1)
+        self.assertEqual(most_at_once(results, 'other'), 2)
+        self.assertTrue(results['other0']['task']['start_time'] <
+                        results['busy1']['task']['start_time'])
+
+    def test_fail_fast(self):
+        """
+        With fail_fast, the first failure cancels queued and running tasks; without it,
+        every task runs
+        """
+        for backend in BACKENDS:
+            with EchoTasks(2, backend=backend, fail_fast=True) as tasks:
+                if backend != 'inline':
+                    tasks.add_task('until-cancelled', 'running')
+                tasks.add_task('fail', 'failing')
+                for i in range(3):
+                    tasks.add_task(i, "queued{0}".format(i))
+                start = time.time()
+                results = tasks.wait()
+
+            self.assertTrue(time.time() - start < 5)
+            self.assertEqual(results['failing']['status'], 'exception')
+            statuses = set(results[name]['status'] for name in results if name != 'failing')
+            self.assertEqual(statuses, set(['cancelled']))
+
+        with EchoTasks(1, backend=BACKEND_THREADS) as tasks:
+            tasks.add_task('fail', 'failing')
+            for i in range(3):
+                tasks.add_task(i, "queued{0}".format(i))
+            results = tasks.wait()
+        self.assertEqual([results["queued{0}".format(i)]['value'] for i in range(3)], [0, 2, 4])
+
+    def test_abort_cancels_running(self):
+        """
+        Leaving the block on an exception asks the running tasks to stop
+        """
+        tasks = EchoTasks(1, backend=BACKEND_THREADS)
+        start = time.time()
+        with self.assertRaises(KeyboardInterrupt):
+            with tasks:
+                tasks.add_task('until-cancelled', 'running')
+                tasks.add_task(1, 'queued')
+                time.sleep(0.2)
+                raise KeyboardInterrupt()
+
+        self.assertTrue(tasks.get_cancel_event().is_set())
+        self.assertTrue(time.time() - start < tasks.abort_timeout)
+
+    def test_add_task_rejects_none(self):
+        """
+        ParallelTasks.add_task refuses a task without data or name
+        """
+        tasks = EchoTasks(1)
+        try:
+            with self.assertRaises(ValueError):
+                tasks.add_task(None, 'name')
+        finally:
+            tasks.finish()
+
+
+class JobAutotunerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tuner = JobAutotuner(minimum=1, maximum=8, start=4)
+        self.tuner._load = lambda: 0
+
+    def test_failures_halve_jobs(self):
+        """
+        JobAutotuner halves the job count after a window with a failure
+        """
+        for i in range(3):
+            self.tuner.observe({'status': 'success', 'task': {'attempt_count': 1}})
+        self.assertEqual(self.tuner.observe({'status': 'exception', 'task': {}}), 2)
+
+    def test_retries_halve_jobs(self):
+        """
+        JobAutotuner halves the job count after a window with a retried task
+        """
+        for i in range(4):
+            jobs = self.tuner.observe({'status': 'success', 'task': {'attempt_count': 2}})
+        self.assertEqual(jobs, 2)
+
+    def test_grows_within_limits(self):
+        """
+        JobAutotuner steps up from a clean first window, and never passes the maximum
+        """
+        for i in range(4):
+            jobs = self.tuner.observe({'status': 'success', 'task': {'attempt_count': 1}})
+        self.assertEqual(jobs, 5)
+
+        self.tuner.jobs = 8
+        self.tuner._last_throughput = 0.001
+        for i in range(8):
+            jobs = self.tuner.observe({'status': 'success', 'task': {'attempt_count': 1}})
+        self.assertEqual(jobs, 8)
+
+    def test_auto_job_count(self):
+        """
+        ParallelTasks accepts 'auto' as its job count
+        """
+        tasks = EchoTasks(JOBS_AUTO, backend='threads')
+        for i in range(6):
+            tasks.add_task(i, "task{0}".format(i))
+        tasks.finish()
+        self.assertEqual(len(tasks.get_results()), 6)
+        self.assertTrue(tasks.get_job_limit() >= 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import unittest
+
+from application.gitbits import GitBit
+from application.git_refs import RefReader
+from application.RepositoryOperator import RepoCloner, RepoOperator
+
+
+class RepoClonerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        remote = os.path.join(self.work_dir, "remote")
+        self.git = GitBit()
+        self.git.set_identity("tester", "tester@example.com")
+        self.git.run(['init', '-q', remote], self.work_dir)
+        self.git.run(['commit', '-q', '--allow-empty', '-m', 'first commit'], remote)
+        self.first = self.git.run(['rev-parse', 'HEAD'], remote)[1].strip()
+        for path in ["top", os.path.join("a", "f"), os.path.join("b", "f")]:
+            if not os.path.isdir(os.path.dirname(os.path.join(remote, path))):
+                os.makedirs(os.path.dirname(os.path.join(remote, path)))
+            with open(os.path.join(remote, path), "w") as new_file:
+                new_file.write(path)
+        self.git.run(['add', '.'], remote)
+        self.git.run(['commit', '-q', '-m', 'second commit'], remote)
+        self.second = self.git.run(['rev-parse', 'HEAD'], remote)[1].strip()
+        self.git.run(['branch', '-M', 'master'], remote)
+        # a file:// URL, so that git treats the remote as it would a server
+        self.url = "file://" + remote
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def checkout(self, repo, clone_mode=None, sync=False, directory="checkout", worktree_of=None):
+        """
+        Check out a repository entry into the work directory
+        :return: the results of the checkout
+        """
+        repo = dict(repo, repository=self.url)
+        repo['checked-out-directory-name'] = directory
+        data = {'repo': repo, 'builddir': self.work_dir, 'clone_mode': clone_mode, 'sync': sync,
+                'worktree_of': worktree_of}
+        results = {}
+        self.git.run_steps(RepoCloner.checkout_steps(data, results))
+        self.assertEqual(results['status'], "success")
+        return results
+
+    def subcommands(self, results):
+        return [command['command'][0] for command in results['commands']]
+
+    def test_pinned_commit_fetched_alone(self):
+        """
+        A shallow checkout of a pinned commit fetches just that commit, onto the branch
+        """
+        results = self.checkout({'branch': 'master', 'commit-id': self.first}, 'shallow')
+        self.assertEqual(self.subcommands(results), ['init', 'remote', 'fetch', 'checkout'])
+
+        checkout = os.path.join(self.work_dir, "checkout")
+        reader = RefReader(checkout)
+        self.assertEqual(reader.head_commit(), self.first)
+        self.assertEqual(reader.current_branch(), "master")
+        self.assertTrue(os.path.isfile(os.path.join(checkout, ".git", "shallow")))
+
+    def test_refused_fetch_falls_back(self):
+        """
+        When the server won't send a commit by id, the whole branch is cloned and reset
+        """
+        environment = dict(os.environ)
+        # the original protocol only allows advertised refs to be fetched
+        os.environ.update({'GIT_CONFIG_COUNT': '1',
+                           'GIT_CONFIG_KEY_0': 'protocol.version',
+                           'GIT_CONFIG_VALUE_0': '0'})
+        try:
+            results = self.checkout({'branch': 'master', 'commit-id': self.first}, 'shallow')
+        finally:
+            os.environ.clear()
+            os.environ.update(environment)
+
+        self.assertEqual(self.subcommands(results), ['clone', 'reset'])
+        self.assertNotIn('--depth', results['commands'][0]['command'])
+        self.assertEqual(RefReader(os.path.join(self.work_dir, "checkout")).head_commit(),
+                         self.first)
+
+    def test_manifest_clone_mode(self):
+        """
+        A repository's own clone-mode overrides the mode for every repository
+        """
+        results = self.checkout({'branch': 'master', 'clone-mode': 'blobless'}, 'shallow')
+        self.assertEqual(self.subcommands(results), ['clone'])
+        self.assertIn('--filter=blob:none', results['commands'][0]['command'])
+
+        with self.assertRaises(ValueError):
+            self.checkout({'branch': 'master', 'clone-mode': 'sparse'})
+
+    def test_sync_in_place(self):
+        """
+        Sync clones a missing checkout, leaves one at the pinned commit alone, and moves
+        one at any other commit
+        """
+        results = self.checkout({'branch': 'master', 'commit-id': self.first}, sync=True)
+        self.assertEqual(self.subcommands(results), ['clone', 'reset'])
+
+        results = self.checkout({'branch': 'master', 'commit-id': self.first}, sync=True)
+        self.assertEqual(results['sync'], "unchanged")
+        self.assertEqual(results['commands'], [])
+
+        results = self.checkout({'branch': 'master', 'commit-id': self.second}, sync=True)
+        self.assertEqual(results['sync'], "updated")
+        self.assertEqual(self.subcommands(results), ['fetch', 'checkout'])
+        reader = RefReader(os.path.join(self.work_dir, "checkout"))
+        self.assertEqual(reader.head_commit(), self.second)
+        self.assertEqual(reader.current_branch(), "master")
+
+    def test_find_worktrees(self):
+        """
+        The first checkout of each URL is cloned, and the others become its worktrees
+        """
+        repo_list = [{'repository': "https://example.com/a.git", 'branch': "master"},
+                     {'repository': "https://example.com/b.git", 'branch': "master"},
+                     {'repository': "https://example.com/a.git", 'commit-id': self.first,
+                      'checked-out-directory-name': "a-old"},
+                     {'repository': "https://example.com/a.git", 'tag': "v1",
+                      'checked-out-directory-name': "a-v1"}]
+        self.assertEqual(RepoCloner.find_worktrees(repo_list), {'a-old': "a", 'a-v1': "a"})
+
+    def test_worktree_checkout(self):
+        """
+        A repeated URL is checked out as a detached worktree of the clone, at its own commit
+        """
+        self.checkout({'branch': 'master'})
+        results = self.checkout({'branch': 'master', 'commit-id': self.first},
+                                directory="old", worktree_of="checkout")
+        self.assertEqual(self.subcommands(results), ['worktree'])
+
+        old = os.path.join(self.work_dir, "old")
+        self.assertTrue(os.path.isfile(os.path.join(old, ".git")))
+        reader = RefReader(old)
+        self.assertEqual(reader.head_commit(), self.first)
+        self.assertIsNone(reader.current_branch())
+        self.assertEqual(RefReader(os.path.join(self.work_dir, "checkout")).head_commit(),
+                         self.second)
+
+        # a sync moves the worktree, leaving it detached
+        results = self.checkout({'branch': 'master', 'commit-id': self.second}, sync=True,
+                                directory="old", worktree_of="checkout")
+        self.assertEqual(results['sync'], "updated")
+        self.assertEqual(RefReader(old).head_commit(), self.second)
+        self.assertIsNone(RefReader(old).current_branch())
+
+    def test_worktree_timeout_retry(self):
+        """
+        A worktree checkout which times out releases the clone's worktree lock, so the retry
+        goes ahead
+        """
+        self.checkout({'branch': 'master'})
+        # a hook which hangs the first time a worktree of the clone is checked out
+        hook = os.path.join(self.work_dir, "checkout", ".git", "hooks", "post-checkout")
+        with open(hook, "w") as hook_file:
+            hook_file.write('#!/bin/sh\n'
+                            'if mkdir "{0}" 2>/dev/null; then sleep 30; fi\n'.format(
+                                os.path.join(self.work_dir, "hung")))
+        os.chmod(hook, stat.S_IRWXU)
+
+        cloner = RepoCloner(1, task_timeout=5, retries=1, retry_delay=0)
+        repo = {'repository': self.url, 'checked-out-directory-name': "old",
+                'branch': 'master', 'commit-id': self.first}
+        cloner.add_task({'repo': repo, 'builddir': self.work_dir, 'worktree_of': "checkout"},
+                        "old")
+        # don't hang the test run if the retry is stuck waiting for the lock
+        waiter = threading.Thread(target=cloner.finish)
+        waiter.daemon = True
+        waiter.start()
+        waiter.join(60)
+        self.assertFalse(waiter.is_alive())
+
+        results = cloner.get_results()["old"]
+        self.assertEqual(results['status'], "success")
+        self.assertEqual(results['task']['attempt_count'], 2)
+        self.assertEqual(RefReader(os.path.join(self.work_dir, "old")).head_commit(), self.first)
+
+    def files(self, directory):
+        """
+        :return: the sorted paths of the files checked out in a directory of the work directory
+        """
+        top = os.path.join(self.work_dir, directory)
+        found = []
+        for path, directories, filenames in os.walk(top):
+            if ".git" in directories:
+                directories.remove(".git")
+            found.extend(os.path.relpath(os.path.join(path, name), top)
+                         for name in filenames if name != ".git")
+        return sorted(found)
+
+    def test_sparse_checkout(self):
+        """
+        Only the sparse-paths are checked out, in clones, worktrees and syncs alike
+        """
+        results = self.checkout({'branch': 'master', 'sparse-paths': ['a']})
+        self.assertIn('--sparse', results['commands'][0]['command'])
+        self.assertIn('--filter=blob:none', results['commands'][0]['command'])
+        self.assertEqual(self.files("checkout"), [os.path.join("a", "f"), "top"])
+
+        self.checkout({'branch': 'master', 'sparse-paths': ['b']},
+                      directory="other", worktree_of="checkout")
+        self.assertEqual(self.files("other"), [os.path.join("b", "f"), "top"])
+        everything = [os.path.join("a", "f"), os.path.join("b", "f"), "top"]
+        self.checkout({'branch': 'master'}, directory="full", worktree_of="checkout")
+        self.assertEqual(self.files("full"), everything)
+
+        self.checkout({'branch': 'master'}, sync=True)
+        self.assertEqual(self.files("checkout"), everything)
+
+    def test_sync_not_a_checkout(self):
+        """
+        A directory which isn't a git checkout is not synced over
+        """
+        os.mkdir(os.path.join(self.work_dir, "checkout"))
+        with self.assertRaises(RuntimeError):
+            self.checkout({'branch': 'master'}, sync=True)
+
+    def test_async_clone_repeated_url(self):
+        """
+        The single-loop clone checks one URL out into each directory the manifest lists it for
+        """
+        repo_list = [{'repository': self.url, 'checked-out-directory-name': "one"},
+                     {'repository': self.url, 'checked-out-directory-name': "two"}]
+        operator = RepoOperator()
+        try:
+            results = operator.clone_repo_list_async(repo_list, self.work_dir)
+        finally:
+            operator.close()
+        self.assertEqual(sorted(results.keys()), [os.path.join(self.work_dir, "one"),
+                                                  os.path.join(self.work_dir, "two")])
+        for directory in ["one", "two"]:
+            self.assertEqual(RefReader(os.path.join(self.work_dir, directory)).head_commit(),
+                             self.second)
+
+
+if __name__ == '__main__':
+    unittest.main()
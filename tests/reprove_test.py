@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from application.gitbits import GitBit
+from application.reprove import ManifestActions
+
+
+class RecordedTasks(object):
+    """
+    Stands in for TaskTrace, keeping the results of every task, including those which never ran
+    """
+    def __init__(self):
+        self.results = {}
+
+    def add_task(self, name, results):
+        self.results[name] = results
+
+    def write(self, filename):
+        pass
+
+
+class ManifestActionsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.builddir = os.path.join(self.work_dir, "build")
+        self.git = GitBit()
+        self.git.set_identity("tester", "tester@example.com")
+        seed = os.path.join(self.work_dir, "seed")
+        self.git.run(['init', '-q', seed], self.work_dir)
+        self.git.run(['commit', '-q', '--allow-empty', '-m', 'first commit'], seed)
+        self.git.run(['branch', '-M', 'master'], seed)
+
+        repositories = []
+        for name in ["alpha", "beta"]:
+            self.git.run(['clone', '-q', '--bare', seed, self.remote(name)], self.work_dir)
+            repositories.append({'repository': self.remote(name), 'branch': 'master'})
+
+        self.manifest = os.path.join(self.work_dir, "manifest.json")
+        self.write_manifest(repositories)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def remote(self, name):
+        return os.path.join(self.work_dir, name + ".git")
+
+    def task(self, step, name):
+        return "{0} {1}".format(step, os.path.join(self.builddir, name))
+
+    def has_branch(self, name, branch):
+        return self.git.run(['rev-parse', '--verify', '--quiet', 'refs/heads/' + branch],
+                            self.remote(name))[0] == 0
+
+    def write_manifest(self, repositories):
+        with open(self.manifest, "w") as manifest_file:
+            json.dump({'build-name': "test",
+                       'build-requirements': "test",
+                       'downstream-jobs': [],
+                       'repositories': repositories
+                      }, manifest_file)
+
+    def manifest_actions(self, *actions):
+        """
+        :return: a ManifestActions for the test manifest, recording its tasks
+        """
+        saved_argv = sys.argv
+        sys.argv = ['reprove.py', '--manifest', self.manifest, '--builddir', self.builddir,
+                    '--branchname', 'rel1', '--tagname', 'v1', '--jobs', '2',
+                    '--no-history'] + list(actions)
+        try:
+            manifest_actions = ManifestActions()
+        finally:
+            sys.argv = saved_argv
+        manifest_actions._task_trace = RecordedTasks()
+        return manifest_actions
+
+    def test_repo_steps(self):
+        """
+        The branch action makes, checks out, updates and then pushes the branch, in that order
+        """
+        manifest_actions = self.manifest_actions('checkout', 'branch')
+        self.assertEqual(manifest_actions.get_repo_steps(),
+                         ['checkout', 'branch', 'checkout-branch', 'branch-packagerefs', 'push'])
+
+    def test_branch_pushed(self):
+        """
+        Each repository's steps run in order, and its push waits for every repository's branch
+        """
+        manifest_actions = self.manifest_actions('checkout', 'branch')
+        manifest_actions.run_repository_tasks()
+
+        results = manifest_actions._task_trace.results
+        self.assertEqual(len(results), 10)
+        self.assertEqual(set(result['status'] for result in results.values()), set(['success']))
+        steps = manifest_actions.get_repo_steps()
+        for name in ["alpha", "beta"]:
+            self.assertTrue(self.has_branch(name, "rel1"))
+            for previous, step in zip(steps, steps[1:]):
+                self.assertTrue(results[self.task(previous, name)]['task']['end_time'] <=
+                                results[self.task(step, name)]['task']['start_time'])
+            for other in ["alpha", "beta"]:
+                self.assertTrue(results[self.task('branch', other)]['task']['end_time'] <=
+                                results[self.task('push', name)]['task']['start_time'])
+
+    def test_failed_branch_pushes_nothing(self):
+        """
+        When the branch can't be made in one repository, that repository's later steps
+        are skipped, and no repository pushes it
+        """
+        self.git.run(['branch', 'rel1', 'master'], self.remote("alpha"))
+        manifest_actions = self.manifest_actions('checkout', 'branch')
+        with self.assertRaises(SystemExit):
+            manifest_actions.run_repository_tasks()
+
+        results = manifest_actions._task_trace.results
+        self.assertEqual(results[self.task('branch', "alpha")]['status'], 'exception')
+        for step in ['checkout-branch', 'branch-packagerefs', 'push']:
+            self.assertEqual(results[self.task(step, "alpha")]['status'], 'skipped')
+        self.assertEqual(results[self.task('checkout-branch', "beta")]['status'], 'success')
+        self.assertEqual(results[self.task('push', "beta")]['status'], 'skipped')
+        self.assertFalse(self.has_branch("beta", "rel1"))
+
+    def test_steps_use_checkout_directory(self):
+        """
+        The steps after the checkout work in the directory the manifest names, rather than
+        one named after the URL
+        """
+        self.write_manifest([{'repository': self.remote("alpha"), 'branch': 'master',
+                              'checked-out-directory-name': "renamed"}])
+        manifest_actions = self.manifest_actions('checkout', 'tag')
+        # the annotated tag needs a tagger
+        manifest_actions.repo_operator.setup_gitbit()
+        manifest_actions.run_repository_tasks()
+
+        self.assertEqual(manifest_actions._task_trace.results[self.task('tag', "renamed")]['status'],
+                         'success')
+        self.assertEqual(self.git.run(['tag', '-l', 'v1'], self.remote("alpha"))[1].strip(), "v1")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from application.task_history import TaskHistory
+
+
+class TaskHistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'history', 'durations.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_history_saved_and_loaded(self):
+        """
+        TaskHistory keeps blended durations across instances
+        """
+        history = TaskHistory(self.filename)
+        self.assertEqual(history.get('repo'), None)
+        history.record('repo', 10.0)
+        history.record('repo', 20.0)
+        history.save()
+
+        self.assertEqual(TaskHistory(self.filename).get('repo'), 15.0)
+
+    def test_longest_first(self):
+        """
+        TaskHistory.longest_first puts unknown items first, then the slowest
+        """
+        history = TaskHistory(self.filename)
+        history.record('small', 1.0)
+        history.record('huge', 100.0)
+        history.record('medium', 10.0)
+
+        ordered = history.longest_first(['small', 'medium', 'new', 'huge'], lambda item: item)
+        self.assertEqual(ordered, ['new', 'huge', 'medium', 'small'])
+
+    def test_unreadable_history_ignored(self):
+        """
+        TaskHistory starts empty when the history file is corrupt
+        """
+        os.makedirs(os.path.dirname(self.filename))
+        with open(self.filename, 'w') as history_file:
+            history_file.write('{not json')
+
+        self.assertEqual(TaskHistory(self.filename).get('repo'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
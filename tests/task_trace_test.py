@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from application.task_trace import TaskTrace
+
+START = datetime.datetime(2016, 1, 1, 12, 0, 0)
+
+
+def at(seconds):
+    return START + datetime.timedelta(seconds=seconds)
+
+
+def task_results(pid, thread, start, end, status='success', commands=()):
+    """
+    :return: results shaped like those of a ParallelTasks task which ran from start to end
+    """
+    return {'status': status,
+            'task': {'pid': pid, 'thread': thread, 'start_time': at(start), 'end_time': at(end),
+                     'attempt_count': 1},
+            'commands': [{'command': command, 'start_time': at(command_start),
+                          'end_time': at(command_end), 'return_code': 0}
+                         for (command, command_start, command_end) in commands]
+           }
+
+
+class TaskTraceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'trace.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def events(self, trace):
+        trace.write(self.filename)
+        with open(self.filename) as trace_file:
+            return json.load(trace_file)['traceEvents']
+
+    def test_lanes(self):
+        """
+        Each (process, thread) gets its own lane, named by metadata events the first time
+        it is seen
+        """
+        trace = TaskTrace()
+        trace.add_task('a', task_results(100, 1, 0, 1))
+        trace.add_task('b', task_results(100, 2, 0, 1))
+        trace.add_task('c', task_results(100, 1, 1, 2))
+        trace.add_task('d', task_results(200, 1, 0, 1))
+        events = self.events(trace)
+
+        lanes = dict((event['name'], (event['pid'], event['tid']))
+                     for event in events if event['ph'] == 'X')
+        self.assertEqual(lanes, {'a': (100, 1), 'b': (100, 2), 'c': (100, 1), 'd': (200, 1)})
+
+        metadata = [(event['name'], event['pid'], event['tid'], event['args']['name'])
+                    for event in events if event['ph'] == 'M']
+        self.assertEqual(metadata, [('process_name', 100, 1, "pid 100"),
+                                    ('thread_name', 100, 1, "worker 1"),
+                                    ('thread_name', 100, 2, "worker 2"),
+                                    ('process_name', 200, 1, "pid 200"),
+                                    ('thread_name', 200, 1, "worker 1")])
+
+    def test_spans(self):
+        """
+        A task's span covers its run, and each of its git commands is a span within it
+        """
+        trace = TaskTrace()
+        trace.add_task('checkout', task_results(100, 1, 0, 3, commands=[
+            (['clone', 'url'], 0.5, 2), (['checkout', '-q', 'v1'], 2, 2.5)]))
+        spans = [event for event in self.events(trace) if event['ph'] == 'X']
+
+        self.assertEqual([(span['name'], span['cat']) for span in spans],
+                         [('checkout', 'task'), ('clone url', 'git'), ('checkout -q v1', 'git')])
+        task = spans[0]
+        self.assertEqual(task['dur'], 3000000)
+        self.assertEqual(task['args'], {'status': 'success', 'attempts': 1})
+        for command in spans[1:]:
+            self.assertEqual((command['pid'], command['tid']), (task['pid'], task['tid']))
+            self.assertTrue(task['ts'] <= command['ts'])
+            self.assertTrue(command['ts'] + command['dur'] <= task['ts'] + task['dur'])
+            self.assertEqual(command['args']['task'], 'checkout')
+        self.assertEqual(spans[1]['dur'], 1500000)
+
+    def test_tasks_not_run_left_out(self):
+        """
+        Tasks which never ran, such as skipped ones, add nothing to the timeline
+        """
+        trace = TaskTrace()
+        trace.add_task('skipped', {'status': 'skipped', 'task': {'name': 'skipped'}})
+        self.assertEqual(self.events(trace), [])
+
+        trace.add_task('ran', task_results(100, 1, 0, 1))
+        self.assertEqual([event['name'] for event in self.events(trace) if event['ph'] == 'X'],
+                         ['ran'])
+
+
+if __name__ == '__main__':
+    unittest.main()